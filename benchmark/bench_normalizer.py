@@ -0,0 +1,129 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Normalizer benchmark
+
+Compares the row dict / iterrows transform addReport used to do against the
+columnar costMatrix + changeFrame path, on synthetic ResultsByTime data.
+
+    python benchmark/bench_normalizer.py [--groups 10,1000,50000] [--months 6]
+
+"""
+
+from __future__ import print_function
+
+import argparse
+import importlib.util
+import logging
+import os
+import random
+import time
+
+import pandas as pd
+
+SRC = os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'src', 'lambda.py')
+
+def loadLambda():
+    #lambda.py is not importable by name (keyword), load it from its path
+    spec = importlib.util.spec_from_file_location('cost_explorer_lambda', SRC)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+def syntheticResults(groups, months, seed=1):
+    #Tag style results, roughly 1 in 10 keys missing in any month
+    rnd = random.Random(seed)
+    results = []
+    for m in range(months):
+        start = '2024-{:02d}-01'.format(m + 1)
+        results.append({
+            'TimePeriod': {'Start': start, 'End': '2024-{:02d}-01'.format(m + 2)},
+            'Total': {},
+            'Groups': [{'Keys': ['Owner$team-{}'.format(g)], 'Metrics': {'UnblendedCost': {'Amount': str(rnd.uniform(0, 1000)), 'Unit': 'USD'}}}
+                for g in range(groups) if rnd.random() > 0.1],
+        })
+    return results
+
+def legacyFrame(results, accounts, Style):
+    #Transform as it was in addReport before costMatrix
+    rows = []
+    sort = ''
+    for v in results:
+        row = {'date':v['TimePeriod']['Start']}
+        sort = v['TimePeriod']['Start']
+        for i in v['Groups']:
+            key = i['Keys'][0]
+            if key in accounts:
+                key = accounts[key]['Email']
+            key = key.replace("Owner$", "")
+            key = key.replace("@nwcdcloud.cn", "")
+            if key == "":
+                key = "(No Tag)"
+            row.update({key:float(i['Metrics']['UnblendedCost']['Amount'])})
+        if not v['Groups']:
+            row.update({'Total':float(v['Total']['UnblendedCost']['Amount'])})
+        rows.append(row)
+
+    df = pd.DataFrame(rows)
+    df.set_index("date", inplace= True)
+    df = df.fillna(0.0)
+
+    if Style == 'Change':
+        dfc = df.copy()
+        lastindex = None
+        for index, row in df.iterrows():
+            if lastindex:
+                for i in row.index:
+                    try:
+                        df.at[index,i] = dfc.at[index,i] - dfc.at[lastindex,i]
+                    except:
+                        logging.exception("Error")
+                        df.at[index,i] = 0
+            lastindex = index
+    df = df.T
+    return df.sort_values(sort, ascending=False)
+
+def columnarFrame(module, results, label, Style):
+    df = module.costMatrix(results, label)
+    sort = df.index[-1]
+    if Style == 'Change':
+        df = module.changeFrame(df)
+    return df.T.sort_values(sort, ascending=False)
+
+def timed(fn, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--groups', default='10,1000,50000', help='comma separated group counts')
+    parser.add_argument('--months', type=int, default=6)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    module = loadLambda()
+    accounts = {}
+    def label(key):
+        #Same mapping as CostExplorer.keyLabel with an empty account directory
+        key = key.replace("Owner$", "").replace("@nwcdcloud.cn", "")
+        return key or "(No Tag)"
+
+    print('{:>8} {:>7} {:>12} {:>12} {:>9}'.format('groups', 'style', 'legacy s', 'columnar s', 'speedup'))
+    for groups in [int(g) for g in args.groups.split(',')]:
+        results = syntheticResults(groups, args.months)
+        for Style in ('Total', 'Change'):
+            #The legacy Change path is cell by cell, one pass is enough at large sizes
+            repeat = 1 if groups * args.months > 100000 else args.repeat
+            legacy, expected = timed(lambda: legacyFrame(results, accounts, Style), repeat)
+            columnar, actual = timed(lambda: columnarFrame(module, results, label, Style), args.repeat)
+            pd.testing.assert_frame_equal(expected.sort_index(), actual.sort_index(), check_names=False, check_column_type=False, check_index_type=False)
+            print('{:>8} {:>7} {:>12.4f} {:>12.4f} {:>8.1f}x'.format(groups, Style, legacy, columnar, legacy / columnar))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,70 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Cold start benchmark
+
+Measures, in a fresh process per run, how long loading src/lambda.py takes,
+which heavy modules it pulls in, and the latency of the first report
+(CostExplorer() plus one addReport) against the fake AWS clients.
+
+    python benchmark/bench_startup.py [--runs 5] [--latency 0.05]
+
+"""
+
+from __future__ import print_function
+
+import argparse
+import multiprocessing
+import statistics
+import sys
+import time
+
+HEAVY = ('pandas', 'numpy', 'dateutil', 'xlsxwriter', 'email.mime.multipart')
+
+def coldStart(latency):
+    #Runs in a spawned process, nothing is imported yet
+    start = time.perf_counter()
+    import boto3
+    boto = time.perf_counter()
+    import fake_aws
+    aws = fake_aws.install(fake_aws.Scenario('startup', latency=latency))
+    before = time.perf_counter()
+    module = fake_aws.loadLambda()
+    loaded = time.perf_counter()
+    heavy = [name for name in HEAVY if name in sys.modules]
+    costexplorer = module.CostExplorer()
+    created = time.perf_counter()
+    initCalls = dict(aws.calls)
+    costexplorer.addReport(Name="Total", GroupBy=[], Style='Total')
+    first = time.perf_counter()
+    return {
+        'boto3_s': boto - start,
+        'import_s': loaded - before,
+        'init_s': created - loaded,
+        'first_report_s': first - created,
+        'heavy_on_import': heavy,
+        'init_calls': initCalls,
+        'first_report_calls': dict(aws.calls),
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--latency', type=float, default=0.05, help='seconds per fake API call')
+    args = parser.parse_args()
+
+    context = multiprocessing.get_context('spawn')
+    runs = []
+    for _ in range(args.runs):
+        with context.Pool(1) as pool:
+            runs.append(pool.apply(coldStart, (args.latency,)))
+    for key in ('boto3_s', 'import_s', 'init_s', 'first_report_s'):
+        values = [run[key] for run in runs]
+        print('{:<16} median {:.4f}  min {:.4f}  max {:.4f}'.format(key, statistics.median(values), min(values), max(values)))
+    print('{:<16} {}'.format('heavy on import', ', '.join(runs[-1]['heavy_on_import']) or 'none'))
+    print('{:<16} {}'.format('init api calls', runs[-1]['init_calls'] or 'none'))
+    print('{:<16} {}'.format('report api calls', runs[-1]['first_report_calls']))
+
+if __name__ == '__main__':
+    main()
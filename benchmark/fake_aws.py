@@ -0,0 +1,257 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Fake AWS clients for offline benchmarks
+
+A local stand-in for the ce, organizations, sts, s3, ses and lambda clients used by
+src/lambda.py. Cost Explorer responses are synthetic but shaped like the real
+API (ResultsByTime / Groups / NextPageToken), at a configurable scale.
+
+    import fake_aws
+    aws = fake_aws.install(fake_aws.Scenario(accounts=50, tag_values=2000))
+    module = fake_aws.loadLambda()
+    module.main_handler()
+    print(aws.calls)
+
+"""
+
+from __future__ import print_function
+
+import datetime
+import hashlib
+import importlib.util
+import os
+import sys
+import threading
+import time
+
+import boto3
+from botocore.exceptions import ClientError
+
+SRC = os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'src', 'lambda.py')
+
+class Scenario(object):
+    """Scale of the synthetic organization and of each Cost Explorer response"""
+    def __init__(self, name='default', accounts=10, services=40, regions=8, tag_values=50, page_size=500, latency=0.05, failing=()):
+        self.name = name
+        self.accounts = accounts
+        self.services = services
+        self.regions = regions
+        self.tag_values = tag_values
+        #Groups per Cost Explorer page, smaller values force pagination
+        self.page_size = page_size
+        #Seconds each API call takes, stands in for the network round trip
+        self.latency = latency
+        #Account ids whose role cannot be assumed, for the missing account paths
+        self.failing = set(failing)
+
+    def accountIds(self):
+        return ['{:012d}'.format(100000000000 + i) for i in range(self.accounts)]
+
+    def values(self, group):
+        if group['Type'] == 'TAG':
+            return ['{}${}-{}'.format(group['Key'], group['Key'].lower(), i) for i in range(self.tag_values)] + ['{}$'.format(group['Key'])]
+        if group['Key'] == 'LINKED_ACCOUNT':
+            return self.accountIds()
+        if group['Key'] == 'REGION':
+            return ['region-{}'.format(i) for i in range(self.regions)]
+        return ['Service {}'.format(i) for i in range(self.services)]
+
+def amount(*parts):
+    #Deterministic cost for a key and period
+    digest = hashlib.md5('|'.join(parts).encode('utf-8')).hexdigest()
+    return '{:.10f}'.format(int(digest[:8], 16) / 4294967.295)
+
+def periods(TimePeriod, Granularity):
+    start = TimePeriod['Start']
+    end = TimePeriod['End']
+    if Granularity == 'HOURLY':
+        current = datetime.datetime.strptime(start, '%Y-%m-%dT%H:%M:%SZ')
+        last = datetime.datetime.strptime(end, '%Y-%m-%dT%H:%M:%SZ')
+        step = datetime.timedelta(hours=1)
+        fmt = '%Y-%m-%dT%H:%M:%SZ'
+    else:
+        current = datetime.datetime.strptime(start[:10], '%Y-%m-%d')
+        last = datetime.datetime.strptime(end[:10], '%Y-%m-%d')
+        step = datetime.timedelta(days=1)
+        fmt = '%Y-%m-%d'
+    while current < last:
+        if Granularity == 'MONTHLY':
+            following = (current.replace(day=1) + datetime.timedelta(days=32)).replace(day=1)
+        else:
+            following = current + step
+        following = min(following, last)
+        yield current.strftime(fmt), following.strftime(fmt)
+        current = following
+
+def instanceDetails(Service, i):
+    #Service specific InstanceDetails, shaped like the real recommendation API
+    region = 'region-{}'.format(i)
+    if 'Relational' in Service:
+        return {'RDSInstanceDetails': {'InstanceType': 'db.r5.{}xlarge'.format(i + 1), 'DatabaseEngine': 'MySQL', 'Region': region}}
+    if 'ElastiCache' in Service:
+        return {'ElastiCacheInstanceDetails': {'NodeType': 'cache.r5.{}xlarge'.format(i + 1), 'Region': region}}
+    if 'OpenSearch' in Service or 'Elasticsearch' in Service:
+        return {'ESInstanceDetails': {'InstanceClass': 'r5', 'InstanceSize': '{}xlarge'.format(i + 1), 'Region': region}}
+    if 'Redshift' in Service:
+        return {'RedshiftInstanceDetails': {'NodeType': 'ra3.{}xlarge'.format(i + 1), 'Region': region}}
+    return {'EC2InstanceDetails': {'InstanceType': 'm5.{}xlarge'.format(i + 1), 'Region': region}}
+
+class FakeAws(object):
+    """Creates fake clients and counts every call made through them"""
+    def __init__(self, scenario):
+        self.scenario = scenario
+        self.calls = {}
+        self.uploads = {}
+        self.emails = []
+        self.invocations = []
+        self.lock = threading.Lock()
+
+    def client(self, service, **kwargs):
+        return FakeClient(self, service)
+
+    def record(self, service, method):
+        with self.lock:
+            name = '{}.{}'.format(service, method)
+            self.calls[name] = self.calls.get(name, 0) + 1
+        if self.scenario.latency:
+            time.sleep(self.scenario.latency)
+
+class FakePaginator(object):
+    def __init__(self, aws, name='list_accounts'):
+        self.aws = aws
+        self.name = name
+
+    def paginate(self, **kwargs):
+        if self.name == 'list_objects_v2':
+            self.aws.record('s3', 'list_objects_v2')
+            yield {'Contents': [{'Key': key} for key in sorted(self.aws.uploads) if key.startswith(kwargs.get('Prefix', ''))]}
+            return
+        ids = self.aws.scenario.accountIds()
+        for start in range(0, len(ids), 20):
+            self.aws.record('organizations', 'list_accounts')
+            yield {'Accounts': [{'Id': i, 'Name': 'account-{}'.format(i[-4:]), 'Email': 'owner-{}@nwcdcloud.cn'.format(i[-4:])} for i in ids[start:start + 20]]}
+
+class FakeClient(object):
+    def __init__(self, aws, service):
+        self.aws = aws
+        self.service = service
+
+    def get_paginator(self, name):
+        return FakePaginator(self.aws, name)
+
+    def get_cost_and_usage(self, TimePeriod, Granularity, Metrics, GroupBy=(), Filter=None, NextPageToken=None):
+        self.aws.record('ce', 'get_cost_and_usage')
+        metric = Metrics[0]
+        keys = [[]]
+        for group in GroupBy:
+            keys = [key + [value] for key in keys for value in self.aws.scenario.values(group)]
+        #Flatten (period, group) pairs, then cut a page of page_size groups like the real API
+        entries = []
+        for start, end in periods(TimePeriod, Granularity):
+            if GroupBy:
+                for key in keys:
+                    entries.append((start, end, key))
+            else:
+                entries.append((start, end, None))
+        offset = int(NextPageToken or 0)
+        page = entries[offset:offset + self.aws.scenario.page_size]
+        results = []
+        for start, end, key in page:
+            if not results or results[-1]['TimePeriod']['Start'] != start:
+                results.append({'TimePeriod': {'Start': start, 'End': end}, 'Total': {}, 'Groups': [], 'Estimated': False})
+            if key is None:
+                results[-1]['Total'] = {metric: {'Amount': amount(start), 'Unit': 'USD'}}
+            else:
+                results[-1]['Groups'].append({'Keys': key, 'Metrics': {metric: {'Amount': amount(start, *key), 'Unit': 'USD'}}})
+        response = {'ResultsByTime': results, 'GroupDefinitions': list(GroupBy)}
+        if offset + len(page) < len(entries):
+            response['NextPageToken'] = str(offset + len(page))
+        return response
+
+    def get_tags(self, TagKey, **kwargs):
+        self.aws.record('ce', 'get_tags')
+        return {'Tags': ['{}-{}'.format(TagKey.lower(), i) for i in range(self.aws.scenario.tag_values)], 'ReturnSize': self.aws.scenario.tag_values, 'TotalSize': self.aws.scenario.tag_values}
+
+    def get_reservation_coverage(self, TimePeriod, Granularity, **kwargs):
+        self.aws.record('ce', 'get_reservation_coverage')
+        return {'CoveragesByTime': [{'TimePeriod': {'Start': start, 'End': end}, 'Total': {'CoverageHours': {'CoverageHoursPercentage': amount('coverage', start)[:5]}}} for start, end in periods(TimePeriod, Granularity)]}
+
+    def get_reservation_utilization(self, TimePeriod, Granularity, **kwargs):
+        self.aws.record('ce', 'get_reservation_utilization')
+        return {'UtilizationsByTime': [{'TimePeriod': {'Start': start, 'End': end}, 'Total': {'UtilizationPercentage': amount('utilization', start)[:5], 'NetRISavings': amount('savings', start)}} for start, end in periods(TimePeriod, Granularity)]}
+
+    def get_reservation_purchase_recommendation(self, Service, PaymentOption='PARTIAL_UPFRONT', TermInYears='ONE_YEAR', **kwargs):
+        self.aws.record('ce', 'get_reservation_purchase_recommendation')
+        details = []
+        for i in range(5):
+            details.append({
+                'InstanceDetails': instanceDetails(Service, i),
+                'RecommendedNumberOfInstancesToPurchase': str(i + 1),
+                'MinimumNumberOfInstancesUsedPerHour': str(i),
+                'MaximumNumberOfInstancesUsedPerHour': str(i + 2),
+                'EstimatedMonthlySavingsAmount': amount(Service, PaymentOption, TermInYears, str(i)),
+                'EstimatedMonthlyOnDemandCost': amount('ondemand', str(i)),
+                'EstimatedBreakEvenInMonths': str(i + 3),
+                'UpfrontCost': amount('upfront', str(i)),
+                'RecurringStandardMonthlyCost': amount('recurring', str(i)),
+            })
+        return {'Recommendations': [{'RecommendationDetails': details}]}
+
+    def assume_role(self, RoleArn, RoleSessionName, **kwargs):
+        self.aws.record('sts', 'assume_role')
+        if RoleArn.split(':')[4] in self.aws.scenario.failing:
+            raise ClientError({'Error': {'Code': 'AccessDenied', 'Message': 'Not authorized to assume {}'.format(RoleArn)}}, 'AssumeRole')
+        return {'Credentials': {'AccessKeyId': 'AKIAFAKE', 'SecretAccessKey': 'fake', 'SessionToken': 'fake',
+            'Expiration': datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(hours=1)}}
+
+    def upload_fileobj(self, Fileobj, Bucket, Key, **kwargs):
+        self.aws.record('s3', 'upload_fileobj')
+        #s3transfer closes the file object it uploads (with fileobj as body)
+        with Fileobj as body:
+            self.aws.uploads[Key] = len(body.read())
+
+    def upload_file(self, Filename, Bucket, Key, **kwargs):
+        self.aws.record('s3', 'upload_file')
+        self.aws.uploads[Key] = os.path.getsize(Filename)
+
+    def put_object(self, Bucket, Key, Body, **kwargs):
+        self.aws.record('s3', 'put_object')
+        self.aws.uploads[Key] = len(Body)
+
+    def download_file(self, Bucket, Key, Filename, **kwargs):
+        self.aws.record('s3', 'download_file')
+        raise IOError('{} not in fake bucket'.format(Key))
+
+    def delete_object(self, Bucket, Key, **kwargs):
+        self.aws.record('s3', 'delete_object')
+        self.aws.uploads.pop(Key, None)
+
+    def invoke(self, FunctionName, InvocationType='RequestResponse', Payload=b'', **kwargs):
+        self.aws.record('lambda', 'invoke')
+        self.aws.invocations.append((FunctionName, InvocationType, Payload))
+        return {'StatusCode': 202}
+
+    def generate_presigned_url(self, ClientMethod, Params, ExpiresIn=3600):
+        return 'https://{}.s3.fake/{}'.format(Params['Bucket'], Params['Key'])
+
+    def send_raw_email(self, Source, Destinations, RawMessage):
+        self.aws.record('ses', 'send_raw_email')
+        self.aws.emails.append((Destinations, len(RawMessage['Data'])))
+        return {'MessageId': 'fake'}
+
+def install(scenario=None):
+    """Routes boto3.client to fake clients, call before loadLambda"""
+    aws = FakeAws(scenario or Scenario())
+    boto3.client = aws.client
+    return aws
+
+def loadLambda():
+    #lambda.py is not importable by name (keyword), load a fresh copy from its path
+    spec = importlib.util.spec_from_file_location('cost_explorer_lambda', SRC)
+    module = importlib.util.module_from_spec(spec)
+    #Registered like a normal import, so process pool workers can pickle its functions
+    sys.modules[spec.name] = module
+    spec.loader.exec_module(module)
+    return module
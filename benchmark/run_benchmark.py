@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+End to end benchmark
+
+Runs main_handler against the fake AWS clients in fake_aws.py, one fresh
+process per scenario, and reports latency, API calls per service and peak RSS.
+No network access or AWS account is needed.
+
+    python benchmark/run_benchmark.py [--scenario wide-tags] [--latency 0.05] [--env MAX_RPS=10] [--json out.json]
+
+"""
+
+from __future__ import print_function
+
+import argparse
+import json
+import multiprocessing
+import os
+import resource
+import time
+
+#name: (Scenario arguments, environment for main_handler)
+SCENARIOS = {
+    'baseline': (
+        dict(accounts=10, tag_values=50),
+        {'COST_TAGS': 'CostGroup'},
+    ),
+    'wide-tags': (
+        dict(accounts=10, tag_values=3000),
+        {'COST_TAGS': 'Team,Owner,Project'},
+    ),
+    'paginated': (
+        dict(accounts=10, tag_values=500, page_size=25),
+        {'COST_TAGS': 'CostGroup'},
+    ),
+    'daily': (
+        dict(accounts=10, tag_values=50),
+        {'COST_TAGS': 'CostGroup', 'GRANULARITY': 'DAILY', 'DAILY_DAYS': '120'},
+    ),
+    'many-accounts': (
+        dict(accounts=80, tag_values=50),
+        {'COST_TAGS': 'Team,Owner', 'GROUP_ACCOUNTS': ','.join('{:012d}'.format(100000000000 + i) for i in range(5))},
+    ),
+}
+#Linked accounts for the summary report in many-accounts
+SCENARIOS['many-accounts'][1]['ACCOUNTS'] = ','.join('{:012d}:owner{}'.format(100000000000 + i, i) for i in range(80))
+
+#Every scenario delivers to the fake S3 / SES
+DELIVERY = {'S3_BUCKET': 'benchmark-bucket', 'SES_SEND': 'to@example.com', 'SES_FROM': 'from@example.com', 'SES_REGION': 'us-east-1'}
+
+def runScenario(name, latency, overrides):
+    #Runs in a fresh spawned process so peak RSS and module caches belong to this scenario only
+    import fake_aws
+    kwargs, env = SCENARIOS[name]
+    os.environ.update(DELIVERY)
+    os.environ.update(env)
+    os.environ.update(overrides)
+    aws = fake_aws.install(fake_aws.Scenario(name, latency=latency, **kwargs))
+    start = time.perf_counter()
+    module = fake_aws.loadLambda()
+    loaded = time.perf_counter()
+    module.main_handler()
+    end = time.perf_counter()
+    return {
+        'scenario': name,
+        'import_s': loaded - start,
+        'handler_s': end - loaded,
+        'calls': aws.calls,
+        'ce_calls': sum(count for call, count in aws.calls.items() if call.startswith('ce.')),
+        'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0,
+        'workbook_bytes': sum(aws.uploads.values()),
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--scenario', action='append', choices=sorted(SCENARIOS), help='scenario to run, repeatable (default all)')
+    parser.add_argument('--latency', type=float, default=0.05, help='seconds per fake API call')
+    parser.add_argument('--env', action='append', default=[], help='KEY=VALUE passed to main_handler, repeatable')
+    parser.add_argument('--json', help='write the results to this file')
+    args = parser.parse_args()
+
+    overrides = dict(item.split('=', 1) for item in args.env)
+    context = multiprocessing.get_context('spawn')
+    results = []
+    print('{:<14} {:>9} {:>10} {:>9} {:>9} {:>12}'.format('scenario', 'import s', 'handler s', 'ce calls', 'rss MB', 'xlsx bytes'))
+    for name in args.scenario or sorted(SCENARIOS):
+        with context.Pool(1) as pool:
+            result = pool.apply(runScenario, (name, args.latency, overrides))
+        results.append(result)
+        print('{:<14} {:>9.3f} {:>10.3f} {:>9} {:>9.1f} {:>12}'.format(
+            name, result['import_s'], result['handler_s'], result['ce_calls'], result['peak_rss_mb'], result['workbook_bytes']))
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+if __name__ == '__main__':
+    main()
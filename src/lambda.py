@@ -16,17 +16,51 @@ import sys
 sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), "./vendored"))
 
 import boto3
+import collections
+import contextlib
 import datetime
+import functools
+import gc
+import hashlib
+import importlib
+import inspect
+import io
+import json
 import logging
-import pandas as pd
+import random
+import sqlite3
+import tempfile
+import threading
+import time
+from array import array
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from concurrent.futures import TimeoutError as FuturesTimeout
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
+from botocore.exceptions import ClientError, ConnectionError as BotoConnectionError, HTTPClientError
+try:
+    import resource
+except ImportError: #Not available on Windows, peak memory is then not reported
+    resource = None
+
+class LazyModule:
+    """Imports the named module on first use, so heavy modules stay out of the cold start"""
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+
+    def __getattr__(self, attr):
+        if self._module is None:
+            self._module = importlib.import_module(self._name)
+        return getattr(self._module, attr)
+
+np = LazyModule('numpy')
+pd = LazyModule('pandas')
+
 #For date
-from dateutil.relativedelta import relativedelta
-#For email
-from email.mime.application import MIMEApplication
-from email.mime.multipart import MIMEMultipart
-from email.mime.text import MIMEText
-from email.utils import COMMASPACE, formatdate
-from openpyxl import load_workbook
+def relativedelta(**kwargs):
+    from dateutil.relativedelta import relativedelta
+    return relativedelta(**kwargs)
 
 #GLOBALS
 SES_REGION = os.environ.get('SES_REGION')
@@ -62,17 +96,884 @@ else:
 TAG_VALUE_FILTER = os.environ.get('TAG_VALUE_FILTER') or '*'
 TAG_KEY = os.environ.get('TAG_KEY')
 
+#Default report granularity, MONTHLY, DAILY or HOURLY, and the lookback of the finer ones
+GRANULARITY = os.environ.get('GRANULARITY') or 'MONTHLY'
+DAILY_DAYS = int(os.environ.get('DAILY_DAYS') or 90)
+HOURLY_DAYS = int(os.environ.get('HOURLY_DAYS') or 2)
+#DAILY and HOURLY requests are split into windows of this size, fetched in parallel
+WINDOWS = {'DAILY': datetime.timedelta(days=30), 'HOURLY': datetime.timedelta(days=1)}
+HOUR_FORMAT = '%Y-%m-%dT%H:%M:%SZ'
+
+#Keep the TOP_N keys of each grouped report by latest period or total spend (TOP_BY latest or total), the rest in OTHER
+#0 keeps every key. TOP_DETAIL true adds a table only sheet with every key next to each capped report
+TOP_N = int(os.environ.get('TOP_N') or 0)
+#Label of the bucket, in parentheses so a real key named Other stays its own row
+OTHER = '(Other)'
+TOP_BY = os.environ.get('TOP_BY') or 'latest'
+TOP_DETAIL = os.environ.get('TOP_DETAIL') == "true"
+
+#Build Total/Services/Regions from one SERVICE x REGION query per filter instead of one query each
+CUBE = os.environ.get('CUBE') == "true"
+
+#Report engine, pandas or lite (pandas free, for Total/Services/Regions style cost reports)
+ENGINE = os.environ.get('ENGINE') or 'pandas'
+
+#Default run report queries concurrently, in original sheet order
+DEFERRED = os.environ.get('DEFERRED')
+if DEFERRED == "false":
+    DEFERRED = False
+else:
+    DEFERRED = True
+
+#Worker pool size and API request ceiling, keep under Cost Explorer API limits
+MAX_WORKERS = int(os.environ.get('MAX_WORKERS') or 4)
+MAX_RPS = float(os.environ.get('MAX_RPS') or 5)
+
+#Throttled, 5xx and connection failures are retried with jittered exponential backoff, CE clients leave retries to us
+#Only the first attempt of a call counts against API_BUDGET
+MAX_RETRIES = int(os.environ.get('MAX_RETRIES') or 5)
+MAX_BACKOFF = float(os.environ.get('MAX_BACKOFF') or 20)
+THROTTLE_CODES = ('ThrottlingException', 'Throttling', 'LimitExceededException', 'TooManyRequestsException', 'RequestLimitExceeded')
+TRANSIENT_CODES = ('InternalServerError', 'InternalFailure', 'ServiceUnavailable', 'RequestTimeout', 'RequestTimeoutException')
+CE_CONFIG = Config(retries={'total_max_attempts': 1})
+
+#Cost Explorer requests allowed per run (0 is unlimited), BUDGET_MODE fail or cache
+#fail stops before a batch that can not fit, cache serves cached months once the budget is spent
+API_BUDGET = int(os.environ.get('API_BUDGET') or 0)
+BUDGET_MODE = os.environ.get('BUDGET_MODE') or 'fail'
+
+#Instrumentation, METRICS true prints CloudWatch Embedded Metric Format lines per stage/report
+#PROFILE_DIR gets a JSON profile of each run, and cProfile stats of main_handler when CPROFILE is true
+METRICS = os.environ.get('METRICS') == "true"
+METRICS_NAMESPACE = os.environ.get('METRICS_NAMESPACE') or 'CostExplorerReport'
+PROFILE_DIR = os.environ.get('PROFILE_DIR')
+CPROFILE = os.environ.get('CPROFILE') == "true"
+
+#Assumed role credentials are refreshed this many seconds before Credentials.Expiration
+CREDENTIAL_REFRESH_SECONDS = int(os.environ.get('CREDENTIAL_REFRESH_SECONDS') or 300)
+
+#Seconds a get_tags lookup is reused across warm invocations, 0 to look up once per run
+TAG_CACHE_TTL = int(os.environ.get('TAG_CACHE_TTL') or 900)
+
+#Seconds the Organizations account directory is reused, in memory and in ACCOUNT_CACHE_FILE across cold starts
+ACCOUNT_CACHE_TTL = int(os.environ.get('ACCOUNT_CACHE_TTL') or 3600)
+ACCOUNT_CACHE_FILE = os.environ.get('ACCOUNT_CACHE_FILE') or '/tmp/cost_explorer_accounts.json'
+
+#Local store of closed month results, only current and previous month are fetched again
+#Optionally synced to S3_BUCKET under RESULT_CACHE_S3_KEY between runs
+RESULT_CACHE_DIR = os.environ.get('RESULT_CACHE_DIR')
+RESULT_CACHE_S3_KEY = os.environ.get('RESULT_CACHE_S3_KEY')
+
+#Report delivery, the workbook is rendered in memory and never written to /tmp
+REPORT_FILENAME = 'cost_explorer_report.xlsx'
+S3_KEY = os.environ.get('S3_KEY') or REPORT_FILENAME
+#Workbooks above this size are uploaded to S3 in parts
+MULTIPART_THRESHOLD = int(os.environ.get('MULTIPART_THRESHOLD') or 8 * 1024 * 1024)
+#Workbooks above this size are emailed as a presigned S3 link instead (SES raw messages are limited to 10MB after base64)
+SES_ATTACHMENT_LIMIT = int(os.environ.get('SES_ATTACHMENT_LIMIT') or 7 * 1024 * 1024)
+PRESIGNED_EXPIRY = int(os.environ.get('PRESIGNED_EXPIRY') or 7 * 24 * 3600)
+
+#RI purchase recommendation matrix of addRiRecommendations, every Service x PaymentOption x Term
+RI_SERVICES = ('Amazon Elastic Compute Cloud - Compute', 'Amazon Relational Database Service', 'Amazon ElastiCache', 'Amazon OpenSearch Service', 'Amazon Redshift')
+RI_PAYMENT_OPTIONS = ('NO_UPFRONT', 'PARTIAL_UPFRONT', 'ALL_UPFRONT')
+RI_TERMS = ('ONE_YEAR', 'THREE_YEARS')
+#true adds the RI coverage, utilization, savings and recommendation matrix sheets to main_handler
+RI_REPORTS = os.environ.get('RI_REPORTS') == "true"
+
+#Tidy (date, report, key, amount) export of every report, EXPORT_FORMAT parquet (needs pyarrow, else csv) or csv
+#One file per report and month under EXPORT_PREFIX in S3_BUCKET (under EXPORT_DIR without S3_BUCKET),
+#closed months that were already exported are not written again
+EXPORT_FORMAT = os.environ.get('EXPORT_FORMAT')
+EXPORT_PREFIX = os.environ.get('EXPORT_PREFIX') or 'cost_explorer_export/'
+EXPORT_DIR = os.environ.get('EXPORT_DIR') or '/tmp'
+#false skips the xlsx render and delivery, for runs that only feed the export
+EXCEL_OUTPUT = os.environ.get('EXCEL_OUTPUT') != "false"
+
+#Pipeline mode, each report is built, written to a /tmp workbook (xlsxwriter constant_memory) and freed in sheet order
+#When the next sheet would take resident memory past MEMORY_CEILING_MB the workbook is closed and the next sheets go to a new part (0 is no ceiling)
+STREAMING = os.environ.get('STREAMING') == "true"
+MEMORY_CEILING_MB = float(os.environ.get('MEMORY_CEILING_MB') or 0)
+
+#TENANT_WORKBOOKS true builds one workbook per GROUP_ACCOUNTS account on a process pool of TENANT_WORKERS,
+#tenants still running after TENANT_TIMEOUT seconds (0 waits) are reported and left out of the emails
+#TENANT_RECIPIENTS overrides SES_SEND per tenant, account=a@example.com;b@example.com comma separated
+TENANT_WORKBOOKS = os.environ.get('TENANT_WORKBOOKS') == "true"
+TENANT_WORKERS = int(os.environ.get('TENANT_WORKERS') or os.cpu_count() or 2)
+TENANT_TIMEOUT = float(os.environ.get('TENANT_TIMEOUT') or 0)
+TENANT_RECIPIENTS = os.environ.get('TENANT_RECIPIENTS') or ''
+
+#CHECKPOINT true saves the query results of a run that nears the Lambda timeout (CHECKPOINT_MARGIN seconds before it)
+#or fails, to CHECKPOINT_DIR and S3_BUCKET/CHECKPOINT_S3_KEY, and the next run resumes without repeating those queries
+#CHECKPOINT_REINVOKE true starts that next run right away, up to CHECKPOINT_MAX_RESUMES times, else the next trigger does
+CHECKPOINT = os.environ.get('CHECKPOINT') == "true"
+CHECKPOINT_DIR = os.environ.get('CHECKPOINT_DIR') or '/tmp'
+CHECKPOINT_S3_KEY = os.environ.get('CHECKPOINT_S3_KEY') or 'cost_explorer_checkpoint.json'
+CHECKPOINT_MARGIN = float(os.environ.get('CHECKPOINT_MARGIN') or 60)
+CHECKPOINT_TTL = int(os.environ.get('CHECKPOINT_TTL') or 6 * 3600)
+CHECKPOINT_REINVOKE = os.environ.get('CHECKPOINT_REINVOKE') == "true"
+CHECKPOINT_MAX_RESUMES = int(os.environ.get('CHECKPOINT_MAX_RESUMES') or 10)
+
+#Query results kept across runs (0 disables), LRU of QUERY_CACHE_SIZE queries, concurrent identical queries share one fetch
+#Service mode (lambda.py --serve) keeps them for an hour unless QUERY_CACHE_TTL is set
+QUERY_CACHE_TTL = int(os.environ.get('QUERY_CACHE_TTL') or 0)
+QUERY_CACHE_SIZE = int(os.environ.get('QUERY_CACHE_SIZE') or 256)
+SERVICE_PORT = int(os.environ.get('SERVICE_PORT') or 8080)
+#Interface the service listens on, local only unless set e.g. to 0.0.0.0 behind an authenticating proxy
+SERVICE_HOST = os.environ.get('SERVICE_HOST') or '127.0.0.1'
+#SERVICE_TRUSTED true lets specs assume roles in any account (AssumeAccount, ACCOUNTS) and deliver to S3 / SES,
+#else specs only name the service's own ACCOUNTS / GROUP_ACCOUNTS and get the workbook back
+SERVICE_TRUSTED = os.environ.get('SERVICE_TRUSTED') == "true"
+#CostExplorer methods a JSON report spec may call
+SPEC_REPORTS = ('addReport', 'addCubeReport', 'addSummaryReport', 'addRiReport', 'addRiRecommendations')
+
+#Module level caches so warm Lambda invocations reuse credentials and clients
+#boto3 default session is not thread safe, so client creation is serialised
+_CLIENT_LOCK = threading.Lock()
+_CLIENTS = {}
+_CREDENTIALS = {}
+_ROLE_LOCKS = {}
+_TAG_CACHE = {}
+_ACCOUNT_LOCK = threading.Lock()
+_ACCOUNT_CACHE = {}
+_RECOMMENDATION_CACHE = {}
+_QUERY_CACHE = None
+_WORKER_LIMITS = None
+
+def assumeRole(accountID, Metrics=None):
+    """Returns cached arm-op-role credentials for accountID, assuming the role again near expiry"""
+    with _CLIENT_LOCK:
+        lock = _ROLE_LOCKS.setdefault(accountID, threading.Lock())
+    with lock: #One STS call per account, other accounts are not blocked
+        credentials = _CREDENTIALS.get(accountID)
+        refresh = datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(seconds=CREDENTIAL_REFRESH_SECONDS)
+        if credentials is None or credentials['Expiration'] <= refresh:
+            sts_connection = LimitedClient(getClient('sts'), metrics=Metrics)
+            with Metrics.stage('sts', accountID) if Metrics else contextlib.nullcontext():
+                acct_cred = sts_connection.assume_role(
+                    RoleArn="arn:aws-cn:iam::"+accountID+":role/arm-op-role",
+                    RoleSessionName="arm_cross_acct"
+                )
+            credentials = acct_cred['Credentials']
+            _CREDENTIALS[accountID] = credentials
+        return credentials
+
+def getClient(service, AssumeAccount=None, Metrics=None, **kwargs):
+    """Returns a cached boto3 client, keyed by service, account and client arguments"""
+    credentials = assumeRole(AssumeAccount, Metrics) if AssumeAccount else None
+    key = (service, AssumeAccount or None, tuple(sorted(kwargs.items())))
+    if service == 'ce':
+        kwargs.setdefault('config', CE_CONFIG)
+    with _CLIENT_LOCK:
+        cached = _CLIENTS.get(key)
+        if cached is None or cached[0] is not credentials: #Rebuild when the role was assumed again
+            if credentials:
+                kwargs.update(aws_access_key_id=credentials['AccessKeyId'], aws_secret_access_key=credentials['SecretAccessKey'], aws_session_token=credentials['SessionToken'])
+            cached = (credentials, boto3.client(service, **kwargs))
+            _CLIENTS[key] = cached
+        return cached[1]
+
+def normalizeQuery(value):
+    #Canonical form of a request, And/Or/Not expressions compare equal in any order
+    if isinstance(value, dict):
+        return {k: normalizeQuery(v) for k, v in value.items()}
+    if isinstance(value, list):
+        items = [normalizeQuery(v) for v in value]
+        if items and all(isinstance(v, dict) for v in items) and not any('Type' in v for v in items):
+            items.sort(key=lambda v: json.dumps(v, sort_keys=True))
+        return items
+    return value
+
+def queryKey(method, request, Account=None):
+    """Hash of the normalized query, equal for reports that only differ in name or style"""
+    query = normalizeQuery({k: v for k, v in request.items() if k != 'NextPageToken'})
+    query.update({'Method': method, 'Account': Account or None})
+    return hashlib.sha256(json.dumps(query, sort_keys=True).encode('utf-8')).hexdigest()
+
+def timeWindows(request):
+    """Splits a ByTime request into consecutive requests of at most one WINDOWS period each"""
+    step = WINDOWS.get(request.get('Granularity'))
+    if not step:
+        return [request]
+    fmt = HOUR_FORMAT if request['Granularity'] == 'HOURLY' else '%Y-%m-%d'
+    start = datetime.datetime.strptime(request['TimePeriod']['Start'], fmt)
+    end = datetime.datetime.strptime(request['TimePeriod']['End'], fmt)
+    windows = []
+    while start < end:
+        following = min(start + step, end)
+        windows.append(dict(request, TimePeriod={'Start': start.strftime(fmt), 'End': following.strftime(fmt)}))
+        start = following
+    return windows or [request]
+
+def accountDirectory(load):
+    """Account directory from memory or ACCOUNT_CACHE_FILE while fresh, otherwise load() and persist it"""
+    with _ACCOUNT_LOCK:
+        cached = _ACCOUNT_CACHE.get('directory')
+        if cached is None and ACCOUNT_CACHE_FILE:
+            try:
+                with open(ACCOUNT_CACHE_FILE) as f:
+                    cached = json.load(f)
+            except (IOError, ValueError):
+                cached = None
+        if cached and time.time() - cached['time'] < ACCOUNT_CACHE_TTL:
+            _ACCOUNT_CACHE['directory'] = cached
+            return cached['accounts']
+        cached = {'time': time.time(), 'accounts': load()}
+        _ACCOUNT_CACHE['directory'] = cached
+        if ACCOUNT_CACHE_FILE and ACCOUNT_CACHE_TTL:
+            try:
+                #Written aside and renamed, so a concurrent reader never sees half a file
+                with open(ACCOUNT_CACHE_FILE + '.tmp', 'w') as f:
+                    json.dump(cached, f, default=str)
+                os.replace(ACCOUNT_CACHE_FILE + '.tmp', ACCOUNT_CACHE_FILE)
+            except (IOError, OSError):
+                logging.exception("Account directory not persisted")
+        return cached['accounts']
+
+def openMonthStart():
+    #Current and previous month are still open (credits, refunds, support), everything before is closed
+    return (datetime.date.today() - relativedelta(months=+1)).replace(day=1)
+
+def isAccountId(key):
+    return len(key) == 12 and key.isdigit()
+
+def costMatrix(results, label=None, Metric='UnblendedCost'):
+    """Columnar form of ResultsByTime entries, a month x key DataFrame filled in one pass
+
+    Raw group keys are interned so label() runs once per distinct key, keys with the same
+    label share a column. Periods without groups go in a 'Total' column.
+    """
+    dates = {}
+    columns = {}
+    labels = {}
+    rows, cols, values = array('q'), array('q'), array('d')
+    for v in results:
+        row = dates.setdefault(v['TimePeriod']['Start'], len(dates))
+        for i in v['Groups']:
+            key = i['Keys'][0]
+            if key not in labels:
+                labels[key] = columns.setdefault(label(key) if label else key, len(columns))
+            rows.append(row)
+            cols.append(labels[key])
+            values.append(float(i['Metrics'][Metric]['Amount']))
+        if not v['Groups']:
+            rows.append(row)
+            cols.append(columns.setdefault('Total', len(columns)))
+            values.append(float(v['Total'][Metric]['Amount']))
+    matrix = np.zeros((len(dates), len(columns)))
+    if values:
+        matrix[np.frombuffer(rows, dtype=np.int64), np.frombuffer(cols, dtype=np.int64)] = np.frombuffer(values)
+    df = pd.DataFrame(matrix, index=pd.Index(list(dates), name='date'), columns=list(columns))
+    return df.sort_index() #Cached and fetched periods can arrive out of order
+
+class LiteFrame:
+    """Pandas free report table, one array('d') row per label under sorted date columns
+
+    Same layout as the transposed cost DataFrames, which is all writeSheet and the charts need.
+    """
+    def __init__(self, index, columns, rows):
+        self.index = index
+        self.columns = columns
+        self.rows = rows
+
+    def __len__(self):
+        return len(self.index)
+
+    @property
+    def empty(self):
+        return not self.index
+
+    @classmethod
+    def fromResults(cls, results, label=None, Metric='UnblendedCost'):
+        #Same interning and 'Total' rule as costMatrix
+        dates = set()
+        labels = {}
+        values = {}
+        for v in results:
+            date = v['TimePeriod']['Start']
+            dates.add(date)
+            for i in v['Groups']:
+                key = i['Keys'][0]
+                if key not in labels:
+                    labels[key] = label(key) if label else key
+                values.setdefault(labels[key], {})[date] = float(i['Metrics'][Metric]['Amount'])
+            if not v['Groups']:
+                values.setdefault('Total', {})[date] = float(v['Total'][Metric]['Amount'])
+        columns = sorted(dates)
+        index = list(values)
+        return cls(index, columns, [array('d', [values[key].get(date, 0.0) for date in columns]) for key in index])
+
+    def styled(self, Style):
+        rows = []
+        for row in self.rows:
+            if Style == 'Change':
+                row = array('d', [row[0]] + [row[i] - row[i - 1] for i in range(1, len(row))]) if row else row
+            elif Style == 'PercentChange':
+                row = array('d', [0.0] + [(row[i] / row[i - 1] - 1) * 100 if row[i - 1] else 0.0 for i in range(1, len(row))]) if row else row
+            elif Style == 'Cumulative':
+                total = 0.0
+                cumulative = array('d')
+                for value in row:
+                    total += value
+                    cumulative.append(total)
+                row = cumulative
+            rows.append(row)
+        return LiteFrame(self.index, self.columns, rows)
+
+    def top(self, TopN, TopBy='latest'):
+        #Same selection as topFrame, the OTHER row is appended last
+        if not TopN or len(self.index) <= TopN:
+            return self
+        spend = [row[-1] if TopBy == 'latest' else sum(row) for row in self.rows]
+        keep = set(sorted(range(len(self.index)), key=lambda i: -spend[i])[:TopN])
+        other = array('d', bytes(self.rows[0].itemsize * len(self.columns)))
+        for i, row in enumerate(self.rows):
+            if i not in keep:
+                for col, value in enumerate(row):
+                    other[col] += value
+        kept = sorted(keep)
+        return LiteFrame([self.index[i] for i in kept] + [OTHER], self.columns, [self.rows[i] for i in kept] + [other])
+
+    def sortedByLast(self, Last=None):
+        #Largest last period first, like sort_values(last date, ascending=False), the Last label stays at the bottom
+        order = sorted(range(len(self.index)), key=lambda i: (self.index[i] == Last, -self.rows[i][-1]))
+        return LiteFrame([self.index[i] for i in order], self.columns, [self.rows[i] for i in order])
+
+    def cells(self):
+        #(label, values) per row, as written by to_excel
+        return zip(self.index, self.rows)
+
+class Cube:
+    """Compact ByTime result of a two key GroupBy, one (date, key, key, amount) cell per group
+
+    Dimension values are stored once and referenced by int codes. rollup() sums the cells over
+    the other dimension, so every sheet built from one cube comes from the same snapshot.
+    """
+    def __init__(self, dimensions):
+        self.dimensions = list(dimensions)
+        self.dates = {}
+        self.values = [{} for _ in self.dimensions]
+        self.dateCodes = array('q')
+        self.codes = [array('q') for _ in self.dimensions]
+        self.amounts = array('d')
+
+    @classmethod
+    def fromResults(cls, results, dimensions, Metric='UnblendedCost'):
+        cube = cls(dimensions)
+        for v in results:
+            date = cube.dates.setdefault(v['TimePeriod']['Start'], len(cube.dates))
+            for i in v['Groups']:
+                cube.dateCodes.append(date)
+                for values, codes, key in zip(cube.values, cube.codes, i['Keys']):
+                    codes.append(values.setdefault(key, len(values)))
+                cube.amounts.append(float(i['Metrics'][Metric]['Amount']))
+        return cube
+
+    def rollup(self, Dimension=None, Metric='UnblendedCost'):
+        """ResultsByTime shaped entries for Dimension summed over the rest, the Total when Dimension is None"""
+        dates = np.frombuffer(self.dateCodes, dtype=np.int64) if self.amounts else np.zeros(0, dtype=np.int64)
+        if Dimension is None:
+            keys, codes = [], np.zeros(len(dates), dtype=np.int64)
+        else:
+            index = self.dimensions.index(Dimension)
+            keys = list(self.values[index])
+            codes = np.frombuffer(self.codes[index], dtype=np.int64) if self.amounts else dates
+        width = max(len(keys), 1)
+        cells = dates * width + codes
+        size = len(self.dates) * width
+        amounts = np.bincount(cells, weights=np.frombuffer(self.amounts) if self.amounts else None, minlength=size).reshape(-1, width)
+        present = np.bincount(cells, minlength=size).reshape(-1, width)
+        results = []
+        for date, row in self.dates.items():
+            if Dimension is None:
+                results.append({'TimePeriod': {'Start': date}, 'Groups': [], 'Total': {Metric: {'Amount': amounts[row, 0]}}})
+            else:
+                results.append({'TimePeriod': {'Start': date}, 'Total': {}, 'Groups': [
+                    {'Keys': [key], 'Metrics': {Metric: {'Amount': amounts[row, col]}}}
+                    for col, key in enumerate(keys) if present[row, col]]})
+        return results
+
+def topFrame(df, TopN, TopBy='latest'):
+    """Keeps the TopN key columns of a date x key frame by latest period or total spend, the rest summed in OTHER"""
+    if not TopN or len(df.columns) <= TopN:
+        return df
+    spend = df.iloc[-1] if TopBy == 'latest' else df.sum()
+    keep = spend.nlargest(TopN).index
+    return df[keep].assign(**{OTHER: df.loc[:, ~df.columns.isin(keep)].sum(axis=1)})
+
+def riFrame(results, Column, value):
+    """One row RI coverage / utilization report, value(entry) per period under the date columns"""
+    rows = [{'date': v['TimePeriod']['Start'], Column: float(value(v))} for v in results]
+    if not rows:
+        return pd.DataFrame(rows), 'table' #Dont try chart empty result
+    df = pd.DataFrame(rows)
+    df.set_index("date", inplace= True)
+    df = df.fillna(0.0)
+    return df.T, 'chart'
+
+def riMissingRow(Service, PaymentOption, Term, e):
+    #Matrix row of a cell whose recommendations could not be fetched
+    code = e.response.get('Error', {}).get('Code') if isinstance(e, ClientError) else None
+    row = {'Service': Service, 'PaymentOption': PaymentOption, 'Term': Term, 'Instance': '(missing: {})'.format(code or e.__class__.__name__), 'Region': ''}
+    row.update(dict.fromkeys(('Recommended', 'Minimum', 'Maximum', 'Savings', 'OnDemand', 'BreakEvenIn', 'UpfrontCost', 'MonthlyCost'), 0.0))
+    return row
+
+def riMatrixFrame(rows):
+    """Recommendation matrix rows by savings, CellRank is the rank within each Service/PaymentOption/Term cell"""
+    df = pd.DataFrame(rows)
+    if df.empty:
+        return df, 'table'
+    df = df.sort_values('Savings', ascending=False, kind='stable').reset_index(drop=True)
+    df['CellRank'] = df.groupby(['Service', 'PaymentOption', 'Term'])['Savings'].rank(ascending=False, method='first').astype(int)
+    return df, 'table'
+
+def changeFrame(df):
+    #Month on month change, the first month is kept as is
+    return df - df.shift(1, fill_value=0.0)
+
+def stringLengths(values):
+    #Longest string in values, other cell types did not count towards autofit widths
+    try:
+        lengths = pd.Series(values, dtype=object).str.len()
+    except AttributeError: #No strings at all
+        return 0
+    return 0 if lengths.isna().all() else int(lengths.max())
+
+def columnWidths(df):
+    """Excel column widths for df as written by to_excel, index column first"""
+    if isinstance(df, LiteFrame):
+        lengths = [max([len(label) for label in df.index if isinstance(label, str)] + [0])] + [len(column) for column in df.columns]
+        return [(length + 2) * 1.2 for length in lengths]
+    lengths = [max(stringLengths([df.index.name, df.columns.name]), stringLengths(df.index))]
+    for num, column in enumerate(df.columns):
+        length = len(column) if isinstance(column, str) else 0
+        if not pd.api.types.is_numeric_dtype(df.dtypes.iloc[num]):
+            length = max(length, stringLengths(df.iloc[:, num]))
+        lengths.append(length)
+    return [(length + 2) * 1.2 for length in lengths]
+
+def peakMemory():
+    #Peak resident set size of the process in MB so far
+    if resource is None:
+        return None
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+def currentMemory():
+    #Resident set size of the process in MB now, from /proc where available, else the peak
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 1024.0 / 1024.0
+    except (IOError, OSError, ValueError, AttributeError):
+        return peakMemory() or 0.0
+
+class Instrumentation:
+    """Wall time per stage and report, API call / page counts, report sizes and peak memory for a run"""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = time.perf_counter()
+        self.stages = []
+        self.counters = {}
+        self.sizes = {}
+
+    @contextlib.contextmanager
+    def stage(self, Stage, Report=None):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            record = {'Stage': Stage, 'Report': Report, 'Duration': (time.perf_counter() - start) * 1000, 'PeakMemory': peakMemory()}
+            with self.lock:
+                self.stages.append(record)
+
+    def count(self, name, amount=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    def size(self, Report, df):
+        with self.lock:
+            self.sizes[Report] = {'Rows': len(df), 'Columns': len(df.columns)}
+
+    def summary(self):
+        stages, reports = {}, {}
+        with self.lock:
+            for record in self.stages:
+                stage = stages.setdefault(record['Stage'], {'Duration': 0.0, 'Count': 0})
+                stage['Duration'] += record['Duration']
+                stage['Count'] += 1
+                if record['Report']:
+                    report = reports.setdefault(record['Report'], {})
+                    report[record['Stage']] = report.get(record['Stage'], 0.0) + record['Duration']
+            for name, size in self.sizes.items():
+                reports.setdefault(name, {}).update(size)
+            return {
+                'Duration': (time.perf_counter() - self.started) * 1000,
+                'PeakMemory': peakMemory(),
+                'Counters': dict(self.counters),
+                'Stages': stages,
+                'Reports': reports,
+            }
+
+    def emit(self, Namespace=METRICS_NAMESPACE):
+        """Prints the run as CloudWatch Embedded Metric Format JSON lines"""
+        summary = self.summary()
+        def line(dimensions, metrics, values):
+            document = {'_aws': {'Timestamp': int(time.time() * 1000), 'CloudWatchMetrics': [{
+                'Namespace': Namespace,
+                'Dimensions': [list(dimensions)],
+                'Metrics': [{'Name': name, 'Unit': unit} for name, unit in metrics.items() if values.get(name) is not None],
+            }]}}
+            document.update(dimensions)
+            document.update({k: v for k, v in values.items() if v is not None})
+            print(json.dumps(document))
+        run = dict(summary['Counters'], Duration=summary['Duration'], PeakMemory=summary['PeakMemory'])
+        units = {name: 'Count' for name in summary['Counters']}
+        units.update({'Duration': 'Milliseconds', 'PeakMemory': 'Megabytes'})
+        line({}, units, run)
+        for name, stage in summary['Stages'].items():
+            line({'Stage': name}, {'Duration': 'Milliseconds', 'Count': 'Count'}, stage)
+        for name, report in summary['Reports'].items():
+            line({'Report': name}, dict({stage: 'Milliseconds' for stage in report if stage not in ('Rows', 'Columns')}, Rows='Count', Columns='Count'), report)
+
+    def dump(self, Directory):
+        #Local profile of the run, one JSON file per run
+        os.makedirs(Directory, exist_ok=True)
+        path = os.path.join(Directory, 'cost_explorer_profile_%d.json' % int(time.time() * 1000))
+        with open(path, 'w') as f:
+            json.dump(dict(self.summary(), Timeline=self.stages), f, indent=2)
+        return path
+
+def profiled(handler):
+    """Runs handler under cProfile when CPROFILE is true, stats go to PROFILE_DIR (or /tmp)"""
+    @functools.wraps(handler)
+    def wrapper(event=None, context=None):
+        if not CPROFILE:
+            return handler(event, context)
+        import cProfile
+        profile = cProfile.Profile()
+        try:
+            return profile.runcall(handler, event, context)
+        finally:
+            profile.dump_stats(os.path.join(PROFILE_DIR or '/tmp', 'main_handler_%d.prof' % int(time.time() * 1000)))
+    return wrapper
+
+def paginate(client, method, request, resultKey=None, metrics=None):
+    """Yields each page of a Cost Explorer call as it arrives, or the resultKey items of each page
+
+    Follow up requests repeat the full request (Filter included) on the same client with NextPageToken.
+    """
+    request = dict(request)
+    while True:
+        response = getattr(client, method)(**request)
+        if metrics:
+            metrics.count('Pages')
+        if resultKey:
+            yield from response[resultKey]
+        else:
+            yield response
+        if not response.get('NextPageToken'):
+            return
+        request['NextPageToken'] = response['NextPageToken']
+
+class ResultCache:
+    """SQLite store of ByTime result entries per month, keyed by a hash of the normalized query"""
+    def __init__(self, Directory, S3Key=None):
+        os.makedirs(Directory, exist_ok=True)
+        self.path = os.path.join(Directory, 'cost_explorer_results.sqlite')
+        self.s3Key = S3Key if os.environ.get('S3_BUCKET') else None
+        if self.s3Key:
+            try:
+                getClient('s3').download_file(os.environ.get('S3_BUCKET'), self.s3Key, self.path)
+            except Exception:
+                logging.exception("Result cache not downloaded from S3, starting empty")
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(self.path, check_same_thread=False)
+        self.db.execute("CREATE TABLE IF NOT EXISTS results (query TEXT, start TEXT, entries TEXT, PRIMARY KEY (query, start))")
+
+    @staticmethod
+    def queryKey(method, request, Account=None):
+        #TimePeriod is left out, months are stored individually
+        return queryKey(method, {k: v for k, v in request.items() if k != 'TimePeriod'}, Account)
+
+    def get(self, key, starts):
+        with self.lock:
+            found = {}
+            for start in starts:
+                row = self.db.execute("SELECT entries FROM results WHERE query=? AND start=?", (key, start)).fetchone()
+                if row:
+                    found[start] = json.loads(row[0])
+            return found
+
+    def put(self, key, months):
+        with self.lock:
+            self.db.executemany("INSERT OR REPLACE INTO results VALUES (?, ?, ?)",
+                [(key, start, json.dumps(entries)) for start, entries in months.items()])
+            self.db.commit()
+
+    def sync(self):
+        if self.s3Key:
+            with self.lock:
+                self.db.commit()
+                getClient('s3').upload_file(self.path, os.environ.get('S3_BUCKET'), self.s3Key)
+
+class QueryCache:
+    """LRU of query results with a TTL, concurrent requests for a key being fetched wait for that one fetch"""
+    def __init__(self, MaxSize=QUERY_CACHE_SIZE, Ttl=QUERY_CACHE_TTL):
+        self.maxSize = MaxSize
+        self.ttl = Ttl
+        self.lock = threading.Lock()
+        self.entries = collections.OrderedDict()
+        self.inflight = {}
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+
+    def get(self, key, fetch):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry and time.time() - entry[0] < self.ttl:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            future = self.inflight.get(key)
+            owner = future is None
+            if owner:
+                future = self.inflight[key] = Future()
+                self.misses += 1
+            else:
+                self.coalesced += 1
+        if not owner:
+            return future.result()
+        try:
+            results = fetch()
+        except BaseException as e:
+            with self.lock:
+                del self.inflight[key]
+            future.set_exception(e)
+            raise
+        with self.lock:
+            del self.inflight[key]
+            self.entries[key] = (time.time(), results)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxSize:
+                self.entries.popitem(last=False)
+        future.set_result(results)
+        return results
+
+    def stats(self):
+        with self.lock:
+            return {'entries': len(self.entries), 'inflight': len(self.inflight), 'hits': self.hits, 'misses': self.misses, 'coalesced': self.coalesced}
+
+def queryCache(Ttl=QUERY_CACHE_TTL):
+    """Returns the module query cache, created on first use when Ttl is set, else None"""
+    global _QUERY_CACHE
+    with _CLIENT_LOCK:
+        if _QUERY_CACHE is None and Ttl:
+            _QUERY_CACHE = QueryCache(QUERY_CACHE_SIZE, Ttl)
+        return _QUERY_CACHE
+
+class RateLimiter:
+    """Token bucket shared by all workers, refilled at MaxRps
+
+    The rate is halved on every throttle and recovers step by step as calls succeed.
+    """
+    def __init__(self, MaxRps=MAX_RPS, Burst=None):
+        self.maxRps = MaxRps
+        self.rate = MaxRps
+        self.burst = Burst or max(1.0, MaxRps)
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def wait(self):
+        if not self.maxRps:
+            return
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= 1 #Reserve a token, callers queue up behind negative balance
+            delay = -self.tokens / self.rate if self.tokens < 0 else 0
+        if delay > 0:
+            time.sleep(delay)
+
+    def throttled(self):
+        with self.lock:
+            self.rate = max(self.maxRps / 16, self.rate / 2)
+
+    def succeeded(self):
+        with self.lock:
+            self.rate = min(self.maxRps, self.rate + self.maxRps / 20)
+
+class BudgetExceeded(Exception):
+    """Raised when a run would make more Cost Explorer requests than API_BUDGET"""
+
+class CheckpointDeadline(Exception):
+    """Raised instead of starting a query once the run is past its checkpoint deadline"""
+
+class CheckpointStore:
+    """Query results of an unfinished run by query key, in a local JSON file backed by S3, for the next run to resume from"""
+    def __init__(self, Directory=CHECKPOINT_DIR, S3Key=CHECKPOINT_S3_KEY):
+        os.makedirs(Directory, exist_ok=True)
+        self.path = os.path.join(Directory, 'cost_explorer_checkpoint.json')
+        self.s3Key = S3Key if os.environ.get('S3_BUCKET') else None
+        self.lock = threading.Lock()
+        self.results = {}
+        if self.s3Key and not os.path.exists(self.path):
+            try:
+                getClient('s3').download_file(os.environ.get('S3_BUCKET'), self.s3Key, self.path)
+            except Exception:
+                pass #No checkpoint, nothing to resume
+        try:
+            with open(self.path) as f:
+                saved = json.load(f)
+            if time.time() - saved['time'] < CHECKPOINT_TTL:
+                self.results = saved['results']
+                print("Resuming from checkpoint, {} queries done, pending {}".format(len(self.results), saved.get('pending')))
+        except (IOError, ValueError, KeyError):
+            pass
+        self.resumed = len(self.results)
+        #Results added by this run, 0 means a step made no progress
+        self.added = 0
+
+    def get(self, key):
+        with self.lock:
+            return self.results.get(key)
+
+    def put(self, key, results):
+        with self.lock:
+            self.added += key not in self.results
+            self.results[key] = results
+
+    def save(self, Pending=()):
+        #Pending report names are kept for the log, the next run rebuilds the same plan and skips saved queries
+        with self.lock:
+            with open(self.path + '.tmp', 'w') as f:
+                json.dump({'time': time.time(), 'results': self.results, 'pending': list(Pending)}, f)
+            os.replace(self.path + '.tmp', self.path)
+        if self.s3Key:
+            getClient('s3').upload_file(self.path, os.environ.get('S3_BUCKET'), self.s3Key)
+        print("Checkpoint saved, {} queries done, pending {}".format(len(self.results), list(Pending)))
+
+    def clear(self):
+        #Run finished, the next one starts fresh
+        with self.lock:
+            self.results = {}
+            if os.path.exists(self.path):
+                os.remove(self.path)
+        if self.s3Key and self.resumed:
+            getClient('s3').delete_object(Bucket=os.environ.get('S3_BUCKET'), Key=self.s3Key)
+
+class ApiBudget:
+    """Counts Cost Explorer requests (charged per request) against a per run budget"""
+    def __init__(self, MaxRequests=API_BUDGET, Mode=BUDGET_MODE):
+        self.max = MaxRequests
+        self.mode = Mode
+        self.spent = 0
+        self.lock = threading.Lock()
+
+    def spend(self):
+        with self.lock:
+            if self.max and self.spent >= self.max:
+                raise BudgetExceeded("API_BUDGET of %d requests spent" % self.max)
+            self.spent += 1
+
+    def check(self, requests):
+        #Fail fast before starting a batch needing at least this many requests
+        with self.lock:
+            if self.max and self.mode == 'fail' and self.spent + requests > self.max:
+                raise BudgetExceeded("%d queries planned, %d of API_BUDGET %d left" % (requests, self.max - self.spent, self.max))
+
+def isThrottle(e):
+    return isinstance(e, ClientError) and e.response.get('Error', {}).get('Code') in THROTTLE_CODES
+
+def isTransient(e):
+    #Server side and network failures botocore would have retried
+    if isinstance(e, (BotoConnectionError, HTTPClientError)):
+        return True
+    return isinstance(e, ClientError) and (e.response.get('Error', {}).get('Code') in TRANSIENT_CODES
+        or e.response.get('ResponseMetadata', {}).get('HTTPStatusCode', 0) >= 500)
+
+class LimitedClient:
+    """Wraps a boto3 client so every API call is budgeted, waits on the shared RateLimiter and retries throttles and transient errors"""
+    def __init__(self, client, limiter=None, budget=None, metrics=None):
+        self._client = client
+        self._limiter = limiter
+        self._budget = budget
+        self._metrics = metrics
+
+    def __getattr__(self, name):
+        attr = getattr(self._client, name)
+        if not callable(attr) or name in ('get_paginator', 'can_paginate'):
+            return attr
+        def call(*args, **kwargs):
+            for attempt in range(MAX_RETRIES + 1):
+                if self._budget and not attempt:
+                    self._budget.spend()
+                if self._limiter:
+                    self._limiter.wait()
+                if self._metrics:
+                    self._metrics.count('ApiCalls')
+                try:
+                    response = attr(*args, **kwargs)
+                except (ClientError, BotoConnectionError, HTTPClientError) as e:
+                    throttle = isThrottle(e)
+                    if not (throttle or isTransient(e)) or attempt == MAX_RETRIES:
+                        raise
+                    if self._metrics:
+                        self._metrics.count('Throttles' if throttle else 'Retries')
+                    if self._limiter and throttle:
+                        self._limiter.throttled()
+                    #Full jitter exponential backoff
+                    time.sleep(random.uniform(0, min(MAX_BACKOFF, 0.5 * 2 ** attempt)))
+                    continue
+                if self._limiter:
+                    self._limiter.succeeded()
+                return response
+        return call
+
 class CostExplorer:
     """Retrieves BillingInfo checks from CostExplorer API
     >>> costexplorer = CostExplorer()
     >>> costexplorer.addReport(GroupBy=[{"Type": "DIMENSION","Key": "SERVICE"}])
     >>> costexplorer.generateExcel()
     """    
-    def __init__(self, CurrentMonth=False):
+    def __init__(self, CurrentMonth=False, Deferred=False, MaxWorkers=MAX_WORKERS, MaxRps=MAX_RPS, Metrics=None, Engine=ENGINE, Streaming=STREAMING, Limiter=None, Checkpoint=None, Deadline=None, Budget=None):
         #Array of reports ready to be output to Excel.
         self.reports = []
+        #lite builds cost reports as LiteFrames and writes the workbook without pandas
+        self.engine = Engine
+        self.metrics = Metrics or Instrumentation()
+        #Deferred mode, add*Report only registers a query, runQueries fetches them all concurrently
+        #Streaming mode is deferred too, generateExcel then builds, writes and frees one report at a time
+        self.streaming = Streaming
+        self.deferred = Deferred or Streaming
+        self.pending = []
+        #Planner state, distinct queries still to fetch and their shared results,
+        #and the API requests of fetches making more than one (for the budget check)
+        self.fetches = {}
+        self.results = {}
+        self.requests = {}
+        self.maxWorkers = MaxWorkers
+        #Checkpoint store and the time.time() after which no new query is started
+        self.checkpoint = Checkpoint
+        self.deadline = Deadline
+        #A shared Limiter keeps concurrent runs (service mode) under one request rate
+        self.limiter = Limiter or RateLimiter(MaxRps)
+        self.budget = Budget or ApiBudget()
+        #Tag values and Filters shared by all reports
+        self.filterLock = threading.Lock()
+        self.tagValues = {}
+        self.filters = {}
+        self.cache = ResultCache(RESULT_CACHE_DIR, RESULT_CACHE_S3_KEY) if RESULT_CACHE_DIR else None
+        #Cubes built from shared results, one per distinct cube query
+        self.cubes = {}
+        self.cubeLock = threading.Lock()
 
-        self.client = boto3.client('ce', region_name='cn-north-1')
+        #Clients and the account directory are created on first use
+        self._client = None
+        self._accounts = None
+        self.accountsLock = threading.Lock()
+        #Sheet label per raw group key, each distinct key is normalized once per run
+        self.labels = {}
         self.end = datetime.date.today().replace(day=1)
         self.riend = datetime.date.today()
         if CurrentMonth or CURRENT_MONTH:
@@ -86,15 +987,112 @@ class CostExplorer:
     
         self.ristart = (datetime.date.today() - relativedelta(months=+11)).replace(day=1) #1st day of month 11 months ago
         self.sixmonth = (datetime.date.today() - relativedelta(months=+6)).replace(day=1) #1st day of month 6 months ago, so RI util has savings values
-        try:
-            self.accounts = self.getAccounts()
-        except:
-            logging.exception("Getting Account names failed")
-            self.accounts = {}
-        
+
+    @property
+    def client(self):
+        if self._client is None:
+            self._client = self.limit(getClient('ce', region_name='cn-north-1'))
+        return self._client
+
+    @property
+    def accounts(self):
+        #Organizations is only paged once a report produces account IDs
+        with self.accountsLock:
+            if self._accounts is None:
+                try:
+                    with self.metrics.stage('accounts'):
+                        self._accounts = accountDirectory(self.getAccounts)
+                except:
+                    logging.exception("Getting Account names failed")
+                    self._accounts = {}
+            return self._accounts
+
+    def limit(self, client):
+        return LimitedClient(client, self.limiter, self.budget, self.metrics)
+
+    def register(self, Name, build, fetch=None, key=None, Requests=1):
+        """Plans a report, build(results) returns (DataFrame, type) from the results of fetch()
+
+        Reports registered with the same key share one fetch, so a query differing only in
+        Style is run once. Deferred mode only records the plan, runQueries executes it.
+        Requests is the number of API requests fetch makes at least, for the budget check.
+        """
+        report = {'Name':sheetName(Name, {report['Name'].lower() for report in self.reports}), 'Data':None, 'Type':'chart'}
+        self.reports.append(report)
+        if key is None:
+            key = ('report', id(report))
+        if fetch:
+            fetch = functools.partial(self.fetch, Name, fetch)
+        if Requests != 1:
+            self.requests[key] = Requests
+        if self.deferred:
+            self.pending.append((report, key, build))
+            if key not in self.results:
+                self.fetches.setdefault(key, fetch)
+        else:
+            if key not in self.results:
+                self.results[key] = fetch() if fetch else None
+            self.build(report, build, self.results[key])
+
+    def fetch(self, Name, fetch):
+        with self.metrics.stage('fetch', Name):
+            return fetch()
+
+    def build(self, report, build, results):
+        with self.metrics.stage('build', report['Name']):
+            report['Data'], report['Type'] = build(results)
+        self.metrics.size(report['Name'], report['Data'])
+
+    def plan(self, Name, method, resultKey, request, build, Account=None):
+        #Canonical query for a ByTime report, shared with every report asking for the same data
+        key = queryKey(method, request, Account)
+        def fetch():
+            client = self.client
+            if Account:
+                client = self.limit(getClient('ce', AssumeAccount=Account, Metrics=self.metrics, region_name='cn-north-1'))
+            #Materialized once here, every report sharing the key builds from this list
+            return list(self.byWindows(client, method, resultKey, request, Account=Account))
+        self.register(Name, build, lambda: self.shared(key, fetch), key)
+
+    def shared(self, key, fetch):
+        #Results kept across runs and shared with concurrent runs when the query cache is on,
+        #and resumed from / saved to the checkpoint when checkpointing
+        if self.checkpoint is not None:
+            results = self.checkpoint.get(key)
+            if results is not None:
+                return results
+            if self.deadline and time.time() > self.deadline:
+                raise CheckpointDeadline("Checkpoint deadline reached, query left for the next run")
+        cache = queryCache()
+        if cache is None:
+            results = fetch()
+        else:
+            results = cache.get(key, fetch)
+        if self.checkpoint is not None:
+            self.checkpoint.put(key, results)
+        return results
+
+    def pendingReports(self):
+        #Reports not built yet, streamed ones were built then released
+        return [report['Name'] for report in self.reports if report['Data'] is None and not report.get('Streamed')]
+
+    def runQueries(self):
+        """Runs each distinct planned query once on a bounded thread pool, then builds reports in sheet order"""
+        pending, self.pending = self.pending, []
+        fetches, self.fetches = self.fetches, {}
+        if not pending:
+            return
+        self.budget.check(sum(self.requests.get(key, 1) for key, fetch in fetches.items() if fetch))
+        with ThreadPoolExecutor(max_workers=self.maxWorkers) as executor:
+            futures = {key: executor.submit(fetch) for key, fetch in fetches.items() if fetch}
+            for key, future in futures.items():
+                self.results[key] = future.result()
+        for report, key, build in pending:
+            self.build(report, build, self.results.get(key))
+
     def getAccounts(self):
         accounts = {}
-        client = boto3.client('organizations', region_name='cn-north-1')
+        client = getClient('organizations', region_name='cn-north-1')
         paginator = client.get_paginator('list_accounts')
         response_iterator = paginator.paginate()
         for response in response_iterator:
@@ -102,115 +1100,175 @@ class CostExplorer:
                 accounts[acc['Id']] = acc
         return accounts
     
-    def addRiReport(self, Name='RICoverage', Savings=False, PaymentOption='PARTIAL_UPFRONT', Service='Amazon Elastic Compute Cloud - Compute'): #Call with Savings True to get Utilization report in dollar savings
-        type = 'chart' #other option table
-        if Name == "RICoverage":
-            results = []
-            response = self.client.get_reservation_coverage(
-                TimePeriod={
-                    'Start': self.ristart.isoformat(),
-                    'End': self.riend.isoformat()
-                },
-                Granularity='MONTHLY'
-            )
-            results.extend(response['CoveragesByTime'])
-            while 'nextToken' in response:
-                nextToken = response['nextToken']
-                response = self.client.get_reservation_coverage(
-                    TimePeriod={
-                        'Start': self.ristart.isoformat(),
-                        'End': self.riend.isoformat()
-                    },
-                    Granularity='MONTHLY',
-                    NextPageToken=nextToken
-                )
-                results.extend(response['CoveragesByTime'])
-                if 'nextToken' in response:
-                    nextToken = response['nextToken']
+    def timePeriod(self, Granularity='MONTHLY', Days=None, Start=None, End=None):
+        #Report period, the configured months for MONTHLY, the last Days (or DAILY_DAYS / HOURLY_DAYS) otherwise
+        if Granularity == 'HOURLY':
+            end = datetime.datetime.now(datetime.timezone.utc).replace(minute=0, second=0, microsecond=0)
+            start = end - datetime.timedelta(days=Days or HOURLY_DAYS)
+            return {'Start': start.strftime(HOUR_FORMAT), 'End': end.strftime(HOUR_FORMAT)}
+        if Granularity == 'DAILY':
+            end = datetime.date.today()
+            start = end - datetime.timedelta(days=Days or DAILY_DAYS)
+        else:
+            start = Start or self.start
+            end = End or self.end
+        return {'Start': start.isoformat(), 'End': end.isoformat()}
+
+    def byWindows(self, client, method, resultKey, request, Account=None):
+        """Yields the ByTime entries for request window by window, in date order
+
+        Windows are fetched in parallel, at most maxWorkers of them are held in memory at a time.
+        """
+        windows = timeWindows(request)
+        if len(windows) == 1:
+            yield from self.byTime(client, method, resultKey, request, Account=Account)
+            return
+        def fetch(window):
+            return list(self.byTime(client, method, resultKey, window, Account=Account))
+        with ThreadPoolExecutor(max_workers=self.maxWorkers) as executor:
+            futures = collections.deque()
+            for window in windows:
+                futures.append(executor.submit(fetch, window))
+                if len(futures) >= self.maxWorkers:
+                    yield from futures.popleft().result()
+            while futures:
+                yield from futures.popleft().result()
+
+    def byTime(self, client, method, resultKey, request, Account=None):
+        """Yields the ByTime entries for request, closed MONTHLY periods come from the result cache when enabled"""
+        if self.cache is None or request.get('Granularity') != 'MONTHLY':
+            yield from paginate(client, method, request, resultKey, self.metrics)
+            return
+        key = ResultCache.queryKey(method, request, Account)
+        start = datetime.date.fromisoformat(request['TimePeriod']['Start'])
+        end = datetime.date.fromisoformat(request['TimePeriod']['End'])
+        openStart = openMonthStart()
+        closed = []
+        month = start
+        while month < min(openStart, end):
+            closed.append(month.isoformat())
+            month = (month + relativedelta(months=+1)).replace(day=1)
+        cached = self.cache.get(key, closed)
+        #Fetch from the first closed month not cached yet, or just the open months
+        missing = [month for month in closed if month not in cached]
+        fetchStart = datetime.date.fromisoformat(missing[0]) if missing else max(start, openStart)
+        for month in closed:
+            if month < fetchStart.isoformat():
+                yield from cached[month]
+        if fetchStart < end:
+            request = dict(request, TimePeriod={'Start': fetchStart.isoformat(), 'End': request['TimePeriod']['End']})
+            months = {}
+            try:
+                for entry in paginate(client, method, request, resultKey, self.metrics):
+                    if entry['TimePeriod']['Start'] in closed:
+                        months.setdefault(entry['TimePeriod']['Start'], []).append(entry)
+                    yield entry
+            except BudgetExceeded:
+                if self.budget.mode != 'cache':
+                    raise
+                #Degrade to cached months, anything not cached is left out of the report
+                logging.warning("API budget spent, %s served from cache only", method)
+                for month in closed:
+                    if month >= fetchStart.isoformat() and month in cached and month not in months:
+                        yield from cached[month]
+                #Pages come in date order, so only the last month seen can be cut short, it is not cached
+                if months:
+                    del months[max(months)]
+            self.cache.put(key, months)
+
+    def buildFilter(self, CreditsOnly=False, RefundOnly=False, UpfrontOnly=False, IncSupport=False, IncTax=True):
+        #Filter is shared by every report with the same options
+        key = (CreditsOnly, RefundOnly, UpfrontOnly, IncSupport, IncTax)
+        with self.filterLock:
+            if key in self.filters:
+                return self.filters[key]
+        Filter = {"And": []}
+
+        Dimensions={"Not": {"Dimensions": {"Key": "RECORD_TYPE","Values": ["Credit", "Refund", "Upfront", "Support"]}}}
+        if INC_SUPPORT or IncSupport: #If global set for including support, we dont exclude it
+            Dimensions={"Not": {"Dimensions": {"Key": "RECORD_TYPE","Values": ["Credit", "Refund", "Upfront"]}}}
+        if CreditsOnly:
+            Dimensions={"Dimensions": {"Key": "RECORD_TYPE","Values": ["Credit",]}}
+        if RefundOnly:
+            Dimensions={"Dimensions": {"Key": "RECORD_TYPE","Values": ["Refund",]}}
+        if UpfrontOnly:
+            Dimensions={"Dimensions": {"Key": "RECORD_TYPE","Values": ["Upfront",]}}
+        if "Not" in Dimensions and (not INC_TAX or not IncTax): #If filtering Record_Types and Tax excluded
+            Dimensions["Not"]["Dimensions"]["Values"].append("Tax")
+
+        tagValues = self.getTagValues()
+
+        if tagValues is not None:
+            Filter["And"].append(Dimensions)
+            if len(tagValues) > 0:
+                Tags = {"Tags": {"Key": TAG_KEY, "Values": tagValues}}
+                Filter["And"].append(Tags)
+        else:
+            Filter = Dimensions.copy()
+        with self.filterLock:
+            return self.filters.setdefault(key, Filter)
+
+    def getTagValues(self):
+        #get_tags lookup for TAG_KEY, once per instance and kept for TAG_CACHE_TTL across warm invocations
+        if not TAG_KEY:
+            return None
+        period = (self.start.isoformat(), datetime.date.today().isoformat())
+        key = (TAG_KEY, TAG_VALUE_FILTER, period)
+        with self.filterLock:
+            if key not in self.tagValues:
+                cached = _TAG_CACHE.get(key)
+                if cached and time.time() - cached[0] < TAG_CACHE_TTL:
+                    self.tagValues[key] = cached[1]
                 else:
-                    nextToken = False
-            
-            rows = []
-            for v in results:
-                row = {'date':v['TimePeriod']['Start']}
-                row.update({'Coverage%':float(v['Total']['CoverageHours']['CoverageHoursPercentage'])})
-                rows.append(row)  
-                    
-            df = pd.DataFrame(rows)
-            df.set_index("date", inplace= True)
-            df = df.fillna(0.0)
-            df = df.T
+                    with self.metrics.stage('tags'):
+                        tagValues = self.client.get_tags(
+                            SearchString=TAG_VALUE_FILTER,
+                            TimePeriod = {
+                                'Start': period[0],
+                                'End': period[1]
+                            },
+                            TagKey=TAG_KEY
+                        )
+                    self.tagValues[key] = tagValues["Tags"]
+                    _TAG_CACHE[key] = (time.time(), tagValues["Tags"])
+            return self.tagValues[key]
+
+    def addRiReport(self, Name='RICoverage', Savings=False, PaymentOption='PARTIAL_UPFRONT', Service='Amazon Elastic Compute Cloud - Compute', Granularity='MONTHLY', Days=None): #Call with Savings True to get Utilization report in dollar savings
+        #Coverage and utilization are planned queries, so they run concurrently with the other reports
+        #and RIUtilization / RIUtilizationSavings share a single fetch
+        if Name == "RICoverage":
+            request = {
+                'TimePeriod': self.timePeriod(Granularity, Days, self.ristart, self.riend),
+                'Granularity': Granularity
+            }
+            self.plan(Name, 'get_reservation_coverage', 'CoveragesByTime', request,
+                lambda results: riFrame(results, 'Coverage%', lambda v: v['Total']['CoverageHours']['CoverageHoursPercentage']))
         elif Name in ['RIUtilization','RIUtilizationSavings']:
             #Only Six month to support savings
-            results = []
-            response = self.client.get_reservation_utilization(
-                TimePeriod={
-                    'Start': self.sixmonth.isoformat(),
-                    'End': self.riend.isoformat()
-                },
-                Granularity='MONTHLY'
-            )
-            results.extend(response['UtilizationsByTime'])
-            while 'nextToken' in response:
-                nextToken = response['nextToken']
-                response = self.client.get_reservation_utilization(
-                    TimePeriod={
-                        'Start': self.sixmonth.isoformat(),
-                        'End': self.riend.isoformat()
-                    },
-                    Granularity='MONTHLY',
-                    NextPageToken=nextToken
-                )
-                results.extend(response['UtilizationsByTime'])
-                if 'nextToken' in response:
-                    nextToken = response['nextToken']
-                else:
-                    nextToken = False
-            
-            rows = []
-            if results:
-                for v in results:
-                    row = {'date':v['TimePeriod']['Start']}
-                    if Savings:
-                        row.update({'Savings$':float(v['Total']['NetRISavings'])})
-                    else:
-                        row.update({'Utilization%':float(v['Total']['UtilizationPercentage'])})
-                    rows.append(row)  
-                        
-                df = pd.DataFrame(rows)
-                df.set_index("date", inplace= True)
-                df = df.fillna(0.0)
-                df = df.T
-                type = 'chart'
+            request = {
+                'TimePeriod': self.timePeriod(Granularity, Days, self.sixmonth, self.riend),
+                'Granularity': Granularity
+            }
+            if Savings:
+                build = lambda results: riFrame(results, 'Savings$', lambda v: v['Total']['NetRISavings'])
             else:
-                df = pd.DataFrame(rows)
-                type = 'table' #Dont try chart empty result
-        elif Name == 'RIRecommendation':
-            results = []
-            response = self.client.get_reservation_purchase_recommendation(
-                #AccountId='string', May use for Linked view
-                LookbackPeriodInDays='SIXTY_DAYS',
-                TermInYears='ONE_YEAR',
-                PaymentOption=PaymentOption,
-                Service=Service
-            )
-            results.extend(response['Recommendations'])
-            while 'nextToken' in response:
-                nextToken = response['nextToken']
-                response = self.client.get_reservation_purchase_recommendation(
-                    #AccountId='string', May use for Linked view
-                    LookbackPeriodInDays='SIXTY_DAYS',
-                    TermInYears='ONE_YEAR',
-                    PaymentOption=PaymentOption,
-                    Service=Service,
-                    NextPageToken=nextToken
-                )
-                results.extend(response['Recommendations'])
-                if 'nextToken' in response:
-                    nextToken = response['nextToken']
-                else:
-                    nextToken = False
-                
+                build = lambda results: riFrame(results, 'Utilization%', lambda v: v['Total']['UtilizationPercentage'])
+            self.plan(Name, 'get_reservation_utilization', 'UtilizationsByTime', request, build)
+        else:
+            self.register(Name, lambda report: report, lambda: self.riReport(Name, Savings, PaymentOption, Service))
+
+    def riReport(self, Name, Savings, PaymentOption, Service):
+        type = 'table' #Dont try chart this
+        if Name == 'RIRecommendation':
+            request = {
+                #'AccountId': 'string', May use for Linked view
+                'LookbackPeriodInDays': 'SIXTY_DAYS',
+                'TermInYears': 'ONE_YEAR',
+                'PaymentOption': PaymentOption,
+                'Service': Service
+            }
+            results = paginate(self.client, 'get_reservation_purchase_recommendation', request, 'Recommendations', self.metrics)
+
             rows = []
             for i in results:
                 for v in i['RecommendationDetails']:
@@ -228,276 +1286,265 @@ class CostExplorer:
                     
             df = pd.DataFrame(rows)
             df = df.fillna(0.0)
-            type = 'table' #Dont try chart this
-        self.reports.append({'Name':Name,'Data':df, 'Type':type})
+        return df, type
+
+    def addRiRecommendations(self, Name='RIRecommendations', Services=RI_SERVICES, PaymentOptions=RI_PAYMENT_OPTIONS, Terms=RI_TERMS, Lookback='SIXTY_DAYS'):
+        """One table of RI purchase recommendations for every Service x PaymentOption x Term cell, by savings
+
+        Cells are fetched concurrently and kept for the day, recommendations are only regenerated daily.
+        """
+        cells = [(service, option, term) for service in Services for option in PaymentOptions for term in Terms]
+        self.register(Name, riMatrixFrame, lambda: self.riMatrix(cells, Lookback), ('riMatrix', tuple(cells), Lookback), Requests=len(cells))
+
+    def riMatrix(self, cells, Lookback):
+        #Rows of every cell, fetched on the worker pool
+        rows = []
+        with ThreadPoolExecutor(max_workers=self.maxWorkers) as executor:
+            futures = [((service, option, term), executor.submit(self.riCell, service, option, term, Lookback)) for service, option, term in cells]
+            for (service, option, term), future in futures:
+                try:
+                    rows.extend(future.result())
+                except CheckpointDeadline:
+                    raise
+                except Exception as e:
+                    #A failing cell, e.g. a service not offered in the partition, is reported, not fatal to the table
+                    logging.exception("RI recommendations for %s %s %s failed", service, option, term)
+                    rows.append(riMissingRow(service, option, term, e))
+        return rows
+
+    def riCell(self, Service, PaymentOption, Term, Lookback):
+        request = {
+            'LookbackPeriodInDays': Lookback,
+            'TermInYears': Term,
+            'PaymentOption': PaymentOption,
+            'Service': Service
+        }
+        key = queryKey('get_reservation_purchase_recommendation', request)
+        today = datetime.date.today().isoformat()
+        cached = _RECOMMENDATION_CACHE.get(key)
+        if cached and cached[0] == today:
+            recommendations = cached[1]
+        else:
+            recommendations = self.cache.get(key, [today]).get(today) if self.cache else None
+            if recommendations is None:
+                recommendations = self.shared(key, lambda: list(paginate(self.client, 'get_reservation_purchase_recommendation', request, 'Recommendations', self.metrics)))
+                if self.cache:
+                    self.cache.put(key, {today: recommendations})
+            _RECOMMENDATION_CACHE[key] = (today, recommendations)
+        rows = []
+        for i in recommendations:
+            for v in i['RecommendationDetails']:
+                #InstanceDetails holds one service specific dict, e.g. EC2InstanceDetails or RedshiftInstanceDetails
+                details = next(iter(v['InstanceDetails'].values()), {})
+                rows.append({
+                    'Service': Service,
+                    'PaymentOption': PaymentOption,
+                    'Term': Term,
+                    'Instance': details.get('InstanceType') or details.get('NodeType') or ' '.join(filter(None, (details.get('InstanceClass'), details.get('InstanceSize')))),
+                    'Region': details.get('Region', ''),
+                    'Recommended': float(v['RecommendedNumberOfInstancesToPurchase']),
+                    'Minimum': float(v['MinimumNumberOfInstancesUsedPerHour']),
+                    'Maximum': float(v['MaximumNumberOfInstancesUsedPerHour']),
+                    'Savings': float(v['EstimatedMonthlySavingsAmount']),
+                    'OnDemand': float(v['EstimatedMonthlyOnDemandCost']),
+                    'BreakEvenIn': float(v['EstimatedBreakEvenInMonths']),
+                    'UpfrontCost': float(v['UpfrontCost']),
+                    'MonthlyCost': float(v['RecurringStandardMonthlyCost']),
+                })
+        return rows
             
     def addLinkedReports(self, Name='RI_{}',PaymentOption='PARTIAL_UPFRONT'):
         pass
             
     def addReport(self, Name="Default",GroupBy=[{"Type": "DIMENSION","Key": "SERVICE"},], 
-    Style='Total', NoCredits=True, CreditsOnly=False, RefundOnly=False, UpfrontOnly=False, IncSupport=False, IncTax=True, AssumeAccount=False):
-        type = 'chart' #other option table
-        results = []
-        if not NoCredits:
-            response = self.client.get_cost_and_usage(
-                TimePeriod={
-                    'Start': self.start.isoformat(),
-                    'End': self.end.isoformat()
-                },
-                Granularity='MONTHLY',
-                Metrics=[
-                    'UnblendedCost',
-                ],
-                GroupBy=GroupBy
-            )
-        else:
-            Filter = {"And": []}
-
-            Dimensions={"Not": {"Dimensions": {"Key": "RECORD_TYPE","Values": ["Credit", "Refund", "Upfront", "Support"]}}}
-            if INC_SUPPORT or IncSupport: #If global set for including support, we dont exclude it
-                Dimensions={"Not": {"Dimensions": {"Key": "RECORD_TYPE","Values": ["Credit", "Refund", "Upfront"]}}}
-            if CreditsOnly:
-                Dimensions={"Dimensions": {"Key": "RECORD_TYPE","Values": ["Credit",]}}
-            if RefundOnly:
-                Dimensions={"Dimensions": {"Key": "RECORD_TYPE","Values": ["Refund",]}}
-            if UpfrontOnly:
-                Dimensions={"Dimensions": {"Key": "RECORD_TYPE","Values": ["Upfront",]}}
-            if "Not" in Dimensions and (not INC_TAX or not IncTax): #If filtering Record_Types and Tax excluded
-                Dimensions["Not"]["Dimensions"]["Values"].append("Tax")
-
-            tagValues = None
-            if TAG_KEY:
-                tagValues = self.client.get_tags(
-                    SearchString=TAG_VALUE_FILTER,
-                    TimePeriod = {
-                        'Start': self.start.isoformat(),
-                        'End': datetime.date.today().isoformat()
-                    },
-                    TagKey=TAG_KEY
-                )
+    Style='Total', NoCredits=True, CreditsOnly=False, RefundOnly=False, UpfrontOnly=False, IncSupport=False, IncTax=True, AssumeAccount=False, Granularity=GRANULARITY, Days=None,
+    TopN=TOP_N, TopBy=TOP_BY, Detail=TOP_DETAIL):
+        request = {
+            'TimePeriod': self.timePeriod(Granularity, Days),
+            'Granularity': Granularity,
+            'Metrics': [
+                'UnblendedCost',
+            ],
+            'GroupBy': GroupBy
+        }
+        if NoCredits:
+            request['Filter'] = self.buildFilter(CreditsOnly, RefundOnly, UpfrontOnly, IncSupport, IncTax)
+        self.plan(Name, 'get_cost_and_usage', 'ResultsByTime', request, lambda results: self.costFrame(results, Style, TopN, TopBy), Account=AssumeAccount)
+        if Detail and TopN and GroupBy:
+            self.plan(detailName(Name), 'get_cost_and_usage', 'ResultsByTime', request, lambda results: (self.costFrame(results, Style)[0], 'table'), Account=AssumeAccount)
 
-            if tagValues:
-                Filter["And"].append(Dimensions)
-                if len(tagValues["Tags"]) > 0:
-                    Tags = {"Tags": {"Key": TAG_KEY, "Values": tagValues["Tags"]}}
-                    Filter["And"].append(Tags)
-            else:
-                Filter = Dimensions.copy()
+    def addCubeReport(self, Name="Default", Dimension=None, GroupBy=[{"Type": "DIMENSION","Key": "SERVICE"},{"Type": "DIMENSION","Key": "REGION"}],
+    Style='Total', NoCredits=True, CreditsOnly=False, RefundOnly=False, UpfrontOnly=False, IncSupport=False, IncTax=True, AssumeAccount=False, Granularity=GRANULARITY, Days=None,
+    TopN=TOP_N, TopBy=TOP_BY, Detail=TOP_DETAIL):
+        """Like addReport, but rolled up locally from one query grouped by both GroupBy keys
 
-            if AssumeAccount:
-                sts_connection = boto3.client('sts')
-                acct_cred = sts_connection.assume_role(
-                    RoleArn="arn:aws-cn:iam::"+AssumeAccount+":role/arm-op-role",
-                    RoleSessionName="arm_cross_acct"
-                )
-                target_acct_client = boto3.client('ce', region_name='cn-north-1', aws_access_key_id=acct_cred['Credentials']['AccessKeyId'], aws_secret_access_key=acct_cred['Credentials']['SecretAccessKey'], aws_session_token=acct_cred['Credentials']['SessionToken'])
-                response = target_acct_client.get_cost_and_usage(
-                    TimePeriod={
-                        'Start': self.start.isoformat(),
-                        'End': self.end.isoformat()
-                    },
-                    Granularity='MONTHLY',
-                    Metrics=[
-                        'UnblendedCost',
-                    ],
-                    GroupBy=GroupBy,
-                    Filter=Filter
-                )
-            else:
-                response = self.client.get_cost_and_usage(
-                    TimePeriod={
-                        'Start': self.start.isoformat(),
-                        'End': self.end.isoformat()
-                    },
-                    Granularity='MONTHLY',
-                    Metrics=[
-                        'UnblendedCost',
-                    ],
-                    GroupBy=GroupBy,
-                    Filter=Filter
-                )
+        Dimension is one of the GroupBy keys (e.g. SERVICE, REGION, LINKED_ACCOUNT), or None for the Total.
+        Cube reports with the same GroupBy and filters share a single query and cube.
+        """
+        request = {
+            'TimePeriod': self.timePeriod(Granularity, Days),
+            'Granularity': Granularity,
+            'Metrics': [
+                'UnblendedCost',
+            ],
+            'GroupBy': GroupBy
+        }
+        if NoCredits:
+            request['Filter'] = self.buildFilter(CreditsOnly, RefundOnly, UpfrontOnly, IncSupport, IncTax)
+        key = queryKey('get_cost_and_usage', request, AssumeAccount)
+        dimensions = [group['Key'] for group in GroupBy]
+        def build(results, TopN=TopN):
+            with self.cubeLock:
+                if key not in self.cubes:
+                    self.cubes[key] = Cube.fromResults(results, dimensions)
+                cube = self.cubes[key]
+            return self.costFrame(cube.rollup(Dimension), Style, TopN, TopBy)
+        self.plan(Name, 'get_cost_and_usage', 'ResultsByTime', request, build, Account=AssumeAccount)
+        if Detail and TopN and Dimension:
+            self.plan(detailName(Name), 'get_cost_and_usage', 'ResultsByTime', request, lambda results: (build(results, None)[0], 'table'), Account=AssumeAccount)
 
-        if response:
-            results.extend(response['ResultsByTime'])
-     
-            while 'nextToken' in response:
-                nextToken = response['nextToken']
-                response = self.client.get_cost_and_usage(
-                    TimePeriod={
-                        'Start': self.start.isoformat(),
-                        'End': self.end.isoformat()
-                    },
-                    Granularity='MONTHLY',
-                    Metrics=[
-                        'UnblendedCost',
-                    ],
-                    GroupBy=GroupBy,
-                    NextPageToken=nextToken
-                )
-     
-                results.extend(response['ResultsByTime'])
-                if 'nextToken' in response:
-                    nextToken = response['nextToken']
-                else:
-                    nextToken = False
-        rows = []
-        sort = ''
-        for v in results:
-            row = {'date':v['TimePeriod']['Start']}
-            sort = v['TimePeriod']['Start']
-            for i in v['Groups']:
-                key = i['Keys'][0]
-                if key in self.accounts:
-                    key = self.accounts[key][ACCOUNT_LABEL]
-                key = key.replace("Owner$", "")
-                key = key.replace("@nwcdcloud.cn", "")
-                if key == "":
-                    key = "(No Tag)"
-                row.update({key:float(i['Metrics']['UnblendedCost']['Amount'])}) 
-            if not v['Groups']:
-                row.update({'Total':float(v['Total']['UnblendedCost']['Amount'])})
-            rows.append(row)
+    def costFrame(self, results, Style='Total', TopN=None, TopBy='latest'):
+        #Builds the report from shared results, so it must not modify them
+        #TopN collapses the tail into OTHER before styling, so it is styled like any key and sorted last
+        type = 'chart' #other option table
+        if self.engine == 'lite':
+            frame = LiteFrame.fromResults(results, self.keyLabel)
+            if frame.empty:
+                return frame, 'table' #Dont try chart empty result
+            other = bool(TopN) and len(frame) > TopN
+            frame = frame.top(TopN, TopBy)
+            return frame.styled(Style).sortedByLast(Last=OTHER if other else None), type
+        df = costMatrix(results, self.keyLabel)
+        if df.empty:
+            return df, 'table' #Dont try chart empty result
+        sort = df.index[-1]
+        other = bool(TopN) and len(df.columns) > TopN
+        df = topFrame(df, TopN, TopBy)
 
-        df = pd.DataFrame(rows)
-        df.set_index("date", inplace= True)
-        df = df.fillna(0.0)
-        
         if Style == 'Change':
-            dfc = df.copy()
-            lastindex = None
-            for index, row in df.iterrows():
-                if lastindex:
-                    for i in row.index:
-                        try:
-                            df.at[index,i] = dfc.at[index,i] - dfc.at[lastindex,i]
-                        except:
-                            logging.exception("Error")
-                            df.at[index,i] = 0
-                lastindex = index
+            df = changeFrame(df)
+        elif Style == 'PercentChange': #Month on month change in percent, 0 where last month had no cost
+            df = (df.pct_change(fill_method=None) * 100).replace([float('inf'), float('-inf')], 0.0).fillna(0.0)
+        elif Style == 'Cumulative':
+            df = df.cumsum()
         df = df.T
         df = df.sort_values(sort, ascending=False)
-        self.reports.append({'Name':Name,'Data':df, 'Type':type})
+        if other:
+            df = pd.concat([df.drop(OTHER), df.loc[[OTHER]]])
+        return df, type
         
         
-    def addSummaryReport(self, Name="Default",GroupBy=[{"Type": "DIMENSION","Key": "SERVICE"},], Style='Total', NoCredits=True, CreditsOnly=False, RefundOnly=False, UpfrontOnly=False, IncSupport=False, IncTax=True, AssumeAccount=False):
+    def keyLabel(self, key, Domain=True):
+        #Sheet label for a raw group key, Domain False keeps the @nwcdcloud.cn suffix (summary rows)
+        label = self.labels.get((key, Domain))
+        if label is None:
+            label = key
+            if isAccountId(label) and label in self.accounts:
+                label = self.accounts[label][ACCOUNT_LABEL]
+            label = label.replace("Owner$", "")
+            if Domain:
+                label = label.replace("@nwcdcloud.cn", "")
+            if label == "":
+                label = "(No Tag)"
+            self.labels[(key, Domain)] = label
+        return label
+
+    def addSummaryReport(self, Name="Default",GroupBy=[{"Type": "DIMENSION","Key": "SERVICE"},], Style='Total', NoCredits=True, CreditsOnly=False, RefundOnly=False, UpfrontOnly=False, IncSupport=False, IncTax=True, AssumeAccount=False, Granularity=GRANULARITY, Days=None, Accounts=None):
+        #Accounts is the ACCOUNTS list, id:login comma separated
+        Accounts = Accounts or os.environ.get('ACCOUNTS')
+        if Accounts: #Support for multiple/different Cost Allocation tags
+            self.register(Name, lambda report: report, lambda: self.summaryReport(GroupBy, CreditsOnly, RefundOnly, UpfrontOnly, IncSupport, IncTax, self.timePeriod(Granularity, Days), Granularity, Accounts))
+
+    def summaryReport(self, GroupBy, CreditsOnly, RefundOnly, UpfrontOnly, IncSupport, IncTax, TimePeriod=None, Granularity='MONTHLY', Accounts=None):
         type = 'chart' #other option table
-        if os.environ.get('ACCOUNTS'): #Support for multiple/different Cost Allocation tags
-            rows = []
-            Filter = {"And": []}
-
-            Dimensions={"Not": {"Dimensions": {"Key": "RECORD_TYPE","Values": ["Credit", "Refund", "Upfront", "Support"]}}}
-            if INC_SUPPORT or IncSupport: #If global set for including support, we dont exclude it
-                Dimensions={"Not": {"Dimensions": {"Key": "RECORD_TYPE","Values": ["Credit", "Refund", "Upfront"]}}}
-            if CreditsOnly:
-                Dimensions={"Dimensions": {"Key": "RECORD_TYPE","Values": ["Credit",]}}
-            if RefundOnly:
-                Dimensions={"Dimensions": {"Key": "RECORD_TYPE","Values": ["Refund",]}}
-            if UpfrontOnly:
-                Dimensions={"Dimensions": {"Key": "RECORD_TYPE","Values": ["Upfront",]}}
-            if "Not" in Dimensions and (not INC_TAX or not IncTax): #If filtering Record_Types and Tax excluded
-                Dimensions["Not"]["Dimensions"]["Values"].append("Tax")
-
-            tagValues = None
-            if TAG_KEY:
-                tagValues = self.client.get_tags(
-                    SearchString=TAG_VALUE_FILTER,
-                    TimePeriod = {
-                        'Start': self.start.isoformat(),
-                        'End': datetime.date.today().isoformat()
-                    },
-                    TagKey=TAG_KEY
-                )
+        rows = []
+        Filter = self.buildFilter(CreditsOnly, RefundOnly, UpfrontOnly, IncSupport, IncTax)
+
+        #Fan out the per account assume role / query / row building, merge back in ACCOUNTS order
+        accounts = (Accounts or os.environ.get('ACCOUNTS')).split(',')
+        missing = []
+        sort = ''
+        with ThreadPoolExecutor(max_workers=self.maxWorkers) as executor:
+            futures = [(account, executor.submit(self.summaryAccount, account, GroupBy, Filter, TimePeriod, Granularity)) for account in accounts]
+            for account, future in futures:
+                try:
+                    accountRows = future.result()
+                except CheckpointDeadline:
+                    raise
+                except Exception as e:
+                    #A failing or throttled account is reported, not fatal to the whole summary
+                    logging.exception("Summary for account %s failed", account)
+                    missing.append((account, e))
+                    continue
+                rows.extend(accountRows)
+                if accountRows:
+                    sort = accountRows[-1]['date']
 
-            if tagValues:
-                Filter["And"].append(Dimensions)
-                if len(tagValues["Tags"]) > 0:
-                    Tags = {"Tags": {"Key": TAG_KEY, "Values": tagValues["Tags"]}}
-                    Filter["And"].append(Tags)
+        merged_data = {}
+        for item in rows:
+            date = item['date']
+            total_key = list(item.keys())[1]  # Assuming the 'date' key is always at index 0
+            total_value = item[total_key]
+            if date in merged_data:
+                merged_data[date][total_key] = total_value
             else:
-                Filter = Dimensions.copy()
-            for account in os.environ.get('ACCOUNTS').split(','):
-                print(account)
-                login=account.split(':')[1]
-                accountID=account.split(':')[0]
-                results = []
-                sts_connection = boto3.client('sts')
-                acct_cred = sts_connection.assume_role(
-                    RoleArn="arn:aws-cn:iam::"+accountID+":role/arm-op-role",
-                    RoleSessionName="arm_cross_acct"
-                )
-                target_acct_client = boto3.client('ce', region_name='cn-north-1', aws_access_key_id=acct_cred['Credentials']['AccessKeyId'], aws_secret_access_key=acct_cred['Credentials']['SecretAccessKey'], aws_session_token=acct_cred['Credentials']['SessionToken'])
-                response = target_acct_client.get_cost_and_usage(
-                    TimePeriod={
-                        'Start': self.start.isoformat(),
-                        'End': self.end.isoformat()
-                    },
-                    Granularity='MONTHLY',
-                    Metrics=[
-                        'UnblendedCost',
-                    ],
-                    GroupBy=GroupBy,
-                    Filter=Filter
-                )
-                if response:
-                    results.extend(response['ResultsByTime'])
-             
-                    while 'nextToken' in response:
-                        nextToken = response['nextToken']
-                        response = self.client.get_cost_and_usage(
-                            TimePeriod={
-                                'Start': self.start.isoformat(),
-                                'End': self.end.isoformat()
-                            },
-                            Granularity='MONTHLY',
-                            Metrics=[
-                                'UnblendedCost',
-                            ],
-                            GroupBy=GroupBy,
-                            NextPageToken=nextToken
-                        )
-             
-                        results.extend(response['ResultsByTime'])
-                        if 'nextToken' in response:
-                            nextToken = response['nextToken']
-                        else:
-                            nextToken = False
-                
-                sort = ''
-                for v in results:
-                    row = {'date':v['TimePeriod']['Start']}
-                    sort = v['TimePeriod']['Start']
-                    for i in v['Groups']:
-                        key = i['Keys'][0]
-                        if key in self.accounts:
-                            key = self.accounts[key][ACCOUNT_LABEL]
-                        key = key.replace("Owner$", "")
-                        if key == "":
-                            key = "(No Tag)"
-                        row.update({key+accountID:float(i['Metrics']['UnblendedCost']['Amount'])}) 
-                    if not v['Groups']:
-                        row.update({login+' '+accountID:float(v['Total']['UnblendedCost']['Amount'])})
-                    rows.append(row) 
-            
-            merged_data = {}
-            for item in rows:
-                date = item['date']
-                total_key = list(item.keys())[1]  # Assuming the 'date' key is always at index 0
-                total_value = item[total_key]
-                if date in merged_data:
-                    merged_data[date][total_key] = total_value
-                else:
-                    merged_data[date] = {total_key: total_value}
-            
-            rows = [{'date': date, **values} for date, values in merged_data.items()]
-                    
+                merged_data[date] = {total_key: total_value}
 
-            df = pd.DataFrame(rows)
+        rows = [{'date': date, **values} for date, values in merged_data.items()]
+
+        df = pd.DataFrame(rows)
+        if rows:
             df.set_index("date", inplace= True)
-            df = df.fillna(0.0)
-            
-            df = df.T
+        df = df.fillna(0.0)
+
+        df = df.T
+        if sort:
             df = df.sort_values(sort, ascending=False)
-            self.reports.append({'Name':Name,'Data':df, 'Type':type}) 
+        #Missing accounts are listed at the bottom of the summary with the failure reason
+        labels = []
+        for account, e in missing:
+            accountID, _, login = account.partition(':')
+            labels.append("{} {} (missing: {})".format(login, accountID, e.__class__.__name__))
+        if missing and not len(df.columns):
+            #No account succeeded so there are no date columns, the summary is a table of the failures
+            df = pd.DataFrame({'Error': [str(e) for account, e in missing]}, index=labels)
+            type = 'table'
+        else:
+            for label in labels:
+                df.loc[label] = 0.0
+        if df.empty:
+            type = 'table' #Dont try chart empty result
+        return df, type
+
+    def summaryAccount(self, account, GroupBy, Filter, TimePeriod=None, Granularity='MONTHLY'):
+        print(account)
+        login=account.split(':')[1]
+        accountID=account.split(':')[0]
+        request = {
+            'TimePeriod': TimePeriod or self.timePeriod(),
+            'Granularity': Granularity,
+            'Metrics': [
+                'UnblendedCost',
+            ],
+            'GroupBy': GroupBy,
+            'Filter': Filter
+        }
+        def fetch():
+            #Role is only assumed when the results are not shared already
+            target_acct_client = self.limit(getClient('ce', AssumeAccount=accountID, Metrics=self.metrics, region_name='cn-north-1'))
+            return list(self.byWindows(target_acct_client, 'get_cost_and_usage', 'ResultsByTime', request, Account=accountID))
+        rows = []
+        with self.metrics.stage('fetch', account):
+            results = self.shared(queryKey('get_cost_and_usage', request, accountID), fetch)
+        for v in results:
+            row = {'date':v['TimePeriod']['Start']}
+            for i in v['Groups']:
+                key = self.keyLabel(i['Keys'][0], Domain=False)
+                row.update({key+accountID:float(i['Metrics']['UnblendedCost']['Amount'])}) 
+            if not v['Groups']:
+                row.update({login+' '+accountID:float(v['Total']['UnblendedCost']['Amount'])})
+            rows.append(row) 
+        return rows
         
     def resourceReport(self, Name="Resource"):
         df = pd.DataFrame(rows)
@@ -507,87 +1554,524 @@ class CostExplorer:
         df = df.T
         self.reports.append({'Name':Name,'Data':df, 'Type':'table'}) 
 
-    def generateExcel(self):
-        # Create a Pandas Excel writer using XlsxWriter as the engine.\
-        os.chdir('/tmp')
-        filepath = 'cost_explorer_report.xlsx'
-        writer = pd.ExcelWriter(filepath, engine='xlsxwriter')
-        workbook = writer.book
-        for report in self.reports:
-            print(report['Name'],report['Type'])
+    def generateExcel(self, Deliver=True):
+        #Returns the workbook buffer, Deliver False skips S3 / SES (service mode replies with it instead)
+        buffer = None
+        if self.streaming:
+            parts = self.streamReports()
+            try:
+                if parts and Deliver:
+                    with self.metrics.stage('deliver'):
+                        deliverReports(parts)
+            finally:
+                for buffer, Filename, Key in parts:
+                    buffer.close()
+                    os.remove(buffer.name)
+        else:
+            #Fetch anything still registered in deferred mode
+            self.runQueries()
+            if self.cache:
+                self.cache.sync()
+        if EXPORT_FORMAT and not self.streaming:
+            with self.metrics.stage('export'):
+                self.metrics.count('ExportFiles', exportReports(self.reports))
+        if EXCEL_OUTPUT and not self.streaming:
+            with self.metrics.stage('excel'):
+                buffer = io.BytesIO()
+                writer = None
+                if self.engine == 'lite':
+                    import xlsxwriter
+                    workbook = xlsxwriter.Workbook(buffer, {'in_memory': True})
+                else:
+                    # Create a Pandas Excel writer using XlsxWriter as the engine.
+                    writer = pd.ExcelWriter(buffer, engine='xlsxwriter')
+                    workbook = writer.book
+                for report in self.reports:
+                    with self.metrics.stage('render', report['Name']):
+                        self.writeSheet(workbook, report, writer)
+                (writer or workbook).close()
+            self.metrics.count('WorkbookBytes', buffer.getbuffer().nbytes)
+
+            if Deliver:
+                with self.metrics.stage('deliver'):
+                    deliverReport(buffer)
+        if METRICS:
+            self.metrics.emit()
+        if PROFILE_DIR:
+            self.metrics.dump(PROFILE_DIR)
+        return buffer
+
+    def streamReports(self):
+        """Pipeline of generateExcel in streaming mode, returns the workbook parts to deliver
+
+        Queries are fetched concurrently, then each report is built, exported, written and released
+        in sheet order, and shared results are dropped once their last report is built.
+        """
+        pending, self.pending = self.pending, []
+        fetches, self.fetches = self.fetches, {}
+        remaining = collections.Counter(key for report, key, build in pending)
+        self.budget.check(sum(self.requests.get(key, 1) for key, fetch in fetches.items() if fetch))
+        existing = exportedKeys(os.environ.get('S3_BUCKET'), EXPORT_PREFIX) if EXPORT_FORMAT else None
+        parts = []
+        try:
+            self.streamPending(pending, fetches, remaining, existing, parts)
+        except BaseException:
+            #Nothing is delivered, e.g. on a checkpoint deadline, so the parts written so far are dropped
+            for buffer, Filename, Key in parts:
+                buffer.close()
+                os.remove(buffer.name)
+            raise
+        for buffer, Filename, Key in parts:
+            self.metrics.count('WorkbookBytes', os.path.getsize(buffer.name))
+        if len(parts) == 1:
+            parts = [(parts[0][0], REPORT_FILENAME, S3_KEY)]
+        if self.cache:
+            self.cache.sync()
+        return parts
+
+    def streamPending(self, pending, fetches, remaining, existing, parts):
+        workbook = None
+        #Queries in sheet order, at most maxWorkers fetched ahead of the report being written
+        queue = collections.deque(key for key, fetch in fetches.items() if fetch)
+        futures = {}
+        with ThreadPoolExecutor(max_workers=self.maxWorkers) as executor:
+            for report, key, build in pending:
+                while queue and (len(futures) < self.maxWorkers or key in queue):
+                    ahead = queue.popleft()
+                    futures[ahead] = executor.submit(fetches[ahead])
+                if key in futures:
+                    self.results[key] = futures.pop(key).result()
+                self.build(report, build, self.results.get(key))
+                remaining[key] -= 1
+                if not remaining[key]:
+                    self.results.pop(key, None)
+                    self.cubes.pop(key, None)
+                if EXPORT_FORMAT:
+                    with self.metrics.stage('export'):
+                        self.metrics.count('ExportFiles', exportReports([report], Existing=existing))
+                if EXCEL_OUTPUT:
+                    if workbook is None:
+                        workbook = self.openPart(parts)
+                        opened = currentMemory()
+                        step = 0
+                    before = currentMemory()
+                    with self.metrics.stage('render', report['Name']):
+                        self.writeSheet(workbook, report)
+                report['Data'] = None
+                report['Streamed'] = True
+                memory = currentMemory() if workbook is not None and MEMORY_CEILING_MB else 0
+                step = max(step, memory - before) if memory else 0
+                #Split before the next sheet, as large as the largest so far, would cross the ceiling. Resident memory hardly
+                #drops once a part is freed, so a part must also have grown by a tenth of the ceiling, else every sheet splits
+                if memory and memory + step > MEMORY_CEILING_MB and memory - opened > MEMORY_CEILING_MB / 10:
+                    #Later sheets go to a new part and this one is flushed to disk and freed
+                    logging.warning("Memory near MEMORY_CEILING_MB after %s, starting workbook part %d", report['Name'], len(parts) + 1)
+                    workbook.close()
+                    workbook = None
+                    gc.collect()
+        if workbook is not None:
+            workbook.close()
+
+    def openPart(self, parts):
+        #New constant_memory workbook part under /tmp, rows are written in order so only one row is held
+        import xlsxwriter
+        number = len(parts) + 1
+        #Unique name, concurrent invocations sharing /tmp never collide, removed by generateExcel after delivery
+        buffer = tempfile.NamedTemporaryFile(prefix='cost_explorer_report_{}_'.format(number), suffix='.xlsx', delete=False)
+        name, extension = os.path.splitext(REPORT_FILENAME)
+        key, keyExtension = os.path.splitext(S3_KEY)
+        parts.append((buffer, '{}_part{}{}'.format(name, number, extension), '{}_part{}{}'.format(key, number, keyExtension)))
+        return xlsxwriter.Workbook(buffer, {'constant_memory': True, 'tmpdir': tempfile.gettempdir()})
+
+    def writeSheet(self, workbook, report, writer=None):
+        print(report['Name'],report['Type'])
+        if writer is not None:
             report['Data'].to_excel(writer, sheet_name=report['Name'])
             worksheet = writer.sheets[report['Name']]
-            if report['Type'] == 'chart':
-                
-                # Create a chart object.
-                chart = workbook.add_chart({'type': 'column', 'subtype': 'stacked'})
-                
-                
-                chartend=6
-                if CURRENT_MONTH:
-                    chartend=7
-                for row_num in range(1, len(report['Data']) + 1):
-                    chart.add_series({
-                        'name':       [report['Name'], row_num, 0],
-                        'categories': [report['Name'], 0, 1, 0, chartend],
-                        'values':     [report['Name'], row_num, 1, row_num, chartend],
-                    })
-                chart.set_y_axis({'label_position': 'low'})
-                chart.set_x_axis({'label_position': 'low'})
-                worksheet.insert_chart('H2', chart, {'x_scale': 2.0, 'y_scale': 2.0})
-        writer.close()
-        workbook = load_workbook(filepath)
-        for sheet_name in workbook.sheetnames:
-            sheet = workbook[sheet_name]
-            for column in sheet.columns:
-                max_length = 0
-                column = [cell for cell in column]
-                for cell in column:
-                    try:
-                        if len(str(cell.value)) > max_length:
-                            max_length = len(cell.value)
-                    except:
-                        pass
-                adjusted_width = (max_length + 2) * 1.2
-                sheet.column_dimensions[column[0].column_letter].width = adjusted_width
-
-        workbook.save(filepath)
-        
-        #Time to deliver the file to S3
-        if os.environ.get('S3_BUCKET'):
-            s3 = boto3.client('s3')
-            s3.upload_file(filepath, os.environ.get('S3_BUCKET'), filepath)
-        if os.environ.get('SES_SEND'):
-            #Email logic
-            msg = MIMEMultipart()
-            msg['From'] = os.environ.get('SES_FROM')
-            msg['To'] = COMMASPACE.join(os.environ.get('SES_SEND').split(","))
-            msg['Date'] = formatdate(localtime=True)
-            msg['Subject'] = "Cost Explorer Report"
-            text = "Find your Cost Explorer report attached\n\n"
-            msg.attach(MIMEText(text))
-            with open(filepath, "rb") as fil:
-                part = MIMEApplication(
-                    fil.read(),
-                    Name=filepath
-                )
-            part['Content-Disposition'] = 'attachment; filename="%s"' % filepath
-            msg.attach(part)
-            #SES Sending
-            ses = boto3.client('ses', region_name=SES_REGION)
-            result = ses.send_raw_email(
-                Source=msg['From'],
-                Destinations=os.environ.get('SES_SEND').split(","),
-                RawMessage={'Data': msg.as_string()}
+        else:
+            worksheet = writeRows(workbook, report['Name'], report['Data'])
+        if report['Type'] == 'chart':
+            
+            # Create a chart object.
+            chart = workbook.add_chart({'type': 'column', 'subtype': 'stacked'})
+            
+            
+            #One category per date column, however many the granularity and period give
+            chartend = len(report['Data'].columns)
+            for row_num in range(1, len(report['Data']) + 1):
+                chart.add_series({
+                    'name':       [report['Name'], row_num, 0],
+                    'categories': [report['Name'], 0, 1, 0, chartend],
+                    'values':     [report['Name'], row_num, 1, row_num, chartend],
+                })
+            chart.set_y_axis({'label_position': 'low'})
+            chart.set_x_axis({'label_position': 'low'})
+            worksheet.insert_chart('H2', chart, {'x_scale': 2.0, 'y_scale': 2.0})
+        #Autofit columns from the data, in the same single write
+        for col, width in enumerate(columnWidths(report['Data'])):
+            worksheet.set_column(col, col, width)
+
+
+def sheetName(Name, used):
+    #Valid Excel tab name not in used (lower case names), at most 31 characters without []:*?/\ and
+    #a ~2, ~3.. suffix where truncation or a repeated name would collide
+    name = ''.join('.' if c in '[]:*?/\\' else c for c in Name)[:31] or 'Sheet'
+    candidate = name
+    number = 2
+    while candidate.lower() in used:
+        suffix = '~{}'.format(number)
+        candidate = name[:31 - len(suffix)] + suffix
+        number += 1
+    return candidate
+
+def detailName(Name):
+    #Sheet name of the full detail table next to a TopN report, within Excel's 31 characters
+    return "{}-Detail".format(Name[:24])
+
+def writeRows(workbook, Name, data):
+    """Writes a LiteFrame (or DataFrame) straight to a new xlsxwriter sheet, in the to_excel layout"""
+    worksheet = workbook.add_worksheet(Name)
+    if isinstance(data, LiteFrame):
+        columns, rows = data.columns, data.cells()
+    else:
+        columns, rows = list(data.columns), ((row[0], row[1:]) for row in data.itertuples(name=None))
+        if data.index.name is not None:
+            #to_excel puts the index label in the corner cell
+            worksheet.write(0, 0, data.index.name)
+    worksheet.write_row(0, 1, columns)
+    for row_num, (label, values) in enumerate(rows, 1):
+        worksheet.write(row_num, 0, label)
+        worksheet.write_row(row_num, 1, [value.item() if hasattr(value, 'item') else value for value in values])
+    return worksheet
+
+def isDate(value):
+    return isinstance(value, str) and value[:4].isdigit() and value[4:5] == '-'
+
+def tidyRows(data):
+    """Yields (date, key, amount) per cell of a key x date report, nothing for tables without date columns"""
+    columns = list(data.columns)
+    if not columns or not all(isDate(column) for column in columns):
+        return
+    if isinstance(data, LiteFrame):
+        cells = data.cells()
+    else:
+        cells = ((row[0], row[1:]) for row in data.itertuples(name=None))
+    for key, values in cells:
+        for date, amount in zip(columns, values):
+            yield date, str(key), float(amount)
+
+def parquetBytes(Name, rows):
+    import pyarrow
+    import pyarrow.parquet
+    dates, keys, amounts = zip(*rows)
+    table = pyarrow.table({
+        'date': [datetime.datetime.strptime(date, HOUR_FORMAT) if 'T' in date else datetime.date.fromisoformat(date) for date in dates],
+        'report': [Name] * len(rows),
+        'key': list(keys),
+        'amount': pyarrow.array(amounts, pyarrow.float64()),
+    })
+    buffer = io.BytesIO()
+    pyarrow.parquet.write_table(table, buffer, compression='zstd')
+    return buffer.getvalue()
+
+def csvBytes(Name, rows):
+    import csv
+    import gzip
+    text = io.StringIO()
+    writer = csv.writer(text)
+    writer.writerow(('date', 'report', 'key', 'amount'))
+    writer.writerows((date, Name, key, amount) for date, key, amount in rows)
+    return gzip.compress(text.getvalue().encode('utf-8'))
+
+def exportedKeys(Bucket, Prefix):
+    #Keys already under Prefix, in S3_BUCKET or under EXPORT_DIR
+    if Bucket:
+        paginator = getClient('s3').get_paginator('list_objects_v2')
+        try:
+            return {item['Key'] for page in paginator.paginate(Bucket=Bucket, Prefix=Prefix) for item in page.get('Contents', [])}
+        except ClientError as e:
+            #No s3:ListBucket, every partition is written again rather than failing the report
+            logging.warning("Listing s3://%s/%s failed (%s), writing every export partition", Bucket, Prefix, e.response.get('Error', {}).get('Code'))
+            return set()
+    keys = set()
+    for root, dirs, files in os.walk(os.path.join(EXPORT_DIR, Prefix)):
+        keys.update(os.path.relpath(os.path.join(root, name), EXPORT_DIR).replace(os.sep, '/') for name in files)
+    return keys
+
+def exportReports(reports, Format=EXPORT_FORMAT, Prefix=EXPORT_PREFIX, Existing=None):
+    """Writes each report as tidy (date, report, key, amount) rows, one file per report and month
+
+    Files are keyed report=<name>/month=<YYYY-MM>/. Closed months that already have a file are left
+    as they are, so a run only adds new partitions and rewrites the open months. Returns files written.
+    """
+    if Format == 'parquet':
+        try:
+            import pyarrow.parquet
+        except ImportError:
+            logging.warning("pyarrow is not available, exporting csv instead of parquet")
+            Format = 'csv'
+    extension = 'parquet' if Format == 'parquet' else 'csv.gz'
+    bucket = os.environ.get('S3_BUCKET')
+    existing = exportedKeys(bucket, Prefix) if Existing is None else Existing
+    openMonth = openMonthStart().isoformat()[:7]
+    written = 0
+    for report in reports:
+        months = {}
+        for date, key, amount in tidyRows(report['Data']):
+            months.setdefault(date[:7], []).append((date, key, amount))
+        for month, rows in sorted(months.items()):
+            path = '{}report={}/month={}/part.{}'.format(Prefix, report['Name'], month, extension)
+            if month < openMonth and path in existing:
+                continue
+            body = parquetBytes(report['Name'], rows) if Format == 'parquet' else csvBytes(report['Name'], rows)
+            if bucket:
+                getClient('s3').put_object(Bucket=bucket, Key=path, Body=body)
+            else:
+                filename = os.path.join(EXPORT_DIR, path)
+                os.makedirs(os.path.dirname(filename), exist_ok=True)
+                with open(filename, 'wb') as f:
+                    f.write(body)
+            written += 1
+    return written
+
+def deliverReport(buffer, Filename=REPORT_FILENAME, Key=S3_KEY):
+    """Streams the in memory workbook to S3 and attaches the same buffer to the SES email"""
+    deliverReports([(buffer, Filename, Key)])
+
+def deliverReports(parts, Recipients=None):
+    """Uploads each (file object, Filename, Key) workbook part to S3, then sends one SES email with all of them"""
+    uploadParts(parts)
+    emailParts(parts, Recipients)
+
+class KeepOpen(object):
+    """File object view that ignores close, upload_fileobj closes what it is given and the part is still emailed after"""
+    def __init__(self, fileobj):
+        self._fileobj = fileobj
+
+    def __getattr__(self, name):
+        return getattr(self._fileobj, name)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def close(self):
+        pass
+
+def uploadParts(parts):
+    #Time to deliver the file to S3
+    if os.environ.get('S3_BUCKET'):
+        s3 = getClient('s3')
+        for buffer, Filename, Key in parts:
+            buffer.seek(0)
+            s3.upload_fileobj(KeepOpen(buffer), os.environ.get('S3_BUCKET'), Key, Config=TransferConfig(multipart_threshold=MULTIPART_THRESHOLD))
+
+def emailParts(parts, Recipients=None):
+    """One SES email to Recipients (default SES_SEND) with every part attached
+
+    When together they are over SES_ATTACHMENT_LIMIT the email carries presigned links to the uploaded parts instead.
+    """
+    Recipients = Recipients or os.environ.get('SES_SEND')
+    if not Recipients:
+        return
+    sizes = [part[0].seek(0, io.SEEK_END) for part in parts]
+    links = {}
+    if os.environ.get('S3_BUCKET') and sum(sizes) > SES_ATTACHMENT_LIMIT:
+        s3 = getClient('s3')
+        for buffer, Filename, Key in parts:
+            #Link expiry is also bounded by the lifetime of the Lambda role credentials
+            links[Filename] = s3.generate_presigned_url('get_object', Params={'Bucket': os.environ.get('S3_BUCKET'), 'Key': Key}, ExpiresIn=PRESIGNED_EXPIRY)
+    #Email logic
+    from email.mime.application import MIMEApplication
+    from email.mime.multipart import MIMEMultipart
+    from email.mime.text import MIMEText
+    from email.utils import COMMASPACE, formatdate
+    msg = MIMEMultipart()
+    msg['From'] = os.environ.get('SES_FROM')
+    msg['To'] = COMMASPACE.join(Recipients.split(","))
+    msg['Date'] = formatdate(localtime=True)
+    msg['Subject'] = "Cost Explorer Report"
+    if links:
+        text = "Your Cost Explorer report is too large to attach, download it here:\n\n%s\n\n" % "\n".join(links[part[1]] for part in parts)
+        msg.attach(MIMEText(text))
+    else:
+        if sum(sizes) > SES_ATTACHMENT_LIMIT:
+            logging.warning("Report is %d bytes, over SES_ATTACHMENT_LIMIT without S3_BUCKET for a link", sum(sizes))
+        text = "Find your Cost Explorer report attached\n\n"
+        msg.attach(MIMEText(text))
+        for buffer, Filename, Key in parts:
+            buffer.seek(0)
+            part = MIMEApplication(
+                buffer.read(),
+                Name=Filename
             )
-    
+            part['Content-Disposition'] = 'attachment; filename="%s"' % Filename
+            msg.attach(part)
+    #SES Sending
+    ses = getClient('ses', region_name=SES_REGION)
+    result = ses.send_raw_email(
+        Source=msg['From'],
+        Destinations=Recipients.split(","),
+        RawMessage={'Data': msg.as_bytes()}
+    )
 
+def tenantPart(Account):
+    #Attachment name and S3 key of a GROUP_ACCOUNTS tenant workbook
+    name, extension = os.path.splitext(REPORT_FILENAME)
+    key, keyExtension = os.path.splitext(S3_KEY)
+    return '{}_{}{}'.format(name, Account, extension), '{}_{}{}'.format(key, Account, keyExtension)
 
-def main_handler(event=None, context=None): 
-    costexplorer = CostExplorer(CurrentMonth=False)
-    if os.environ.get('ACCOUNTS'): #Support for multiple/different Cost Allocation tags
-        costexplorer.addSummaryReport(Name="Summary", GroupBy=[],Style='Total',IncSupport=True)
-        #for account in os.environ.get('ACCOUNTS').split(','):
+def tenantFile(Account):
+    #Unique local file for a tenant workbook, concurrent invocations sharing /tmp never collide
+    fd, path = tempfile.mkstemp(prefix='cost_explorer_report_{}_'.format(Account), suffix=os.path.splitext(REPORT_FILENAME)[1])
+    os.close(fd)
+    return path
+
+def tenantRecipients(Account):
+    #TENANT_RECIPIENTS entry of the account, SES_SEND otherwise
+    for entry in TENANT_RECIPIENTS.split(','):
+        account, _, recipients = entry.partition('=')
+        if account.strip() == Account and recipients:
+            return recipients.replace(';', ',')
+    return os.environ.get('SES_SEND')
+
+def resetClients(MaxRps=MAX_RPS, MaxRequests=API_BUDGET):
+    #Pool worker initializer, clients and connections are not shared with a forked parent,
+    #and the worker's tenants share its slice of the run's MAX_RPS and API_BUDGET
+    global _WORKER_LIMITS
+    _CLIENTS.clear()
+    _CREDENTIALS.clear()
+    _WORKER_LIMITS = (RateLimiter(MaxRps), ApiBudget(MaxRequests))
+
+def tenantWorkbook(Account, CostTags, Path, Limiter=None, Budget=None):
+    """Builds and uploads the workbook of one GROUP_ACCOUNTS tenant, returns its status row
+
+    Runs in a pool worker, the workbook is left in the /tmp file Path for the parent to email.
+    Thread workers pass the parent's Limiter and Budget, process workers use their share from resetClients.
+    """
+    start = time.time()
+    status = {'tenant': Account, 'status': 'ok', 'sheets': 0, 'bytes': 0, 'seconds': 0.0, 'error': None}
+    if Limiter is None and _WORKER_LIMITS is not None:
+        Limiter, Budget = _WORKER_LIMITS
+    try:
+        costexplorer = CostExplorer(CurrentMonth=False, Deferred=DEFERRED, Streaming=False, Limiter=Limiter, Budget=Budget)
+        for tagkey in CostTags.split(','):
+            tabname = tagkey.replace(":",".") #Remove special chars from Excel tabname
+            costexplorer.addReport(Name=tabname, GroupBy=[{"Type": "TAG","Key": tagkey}],Style='Total', AssumeAccount=Account)
+        buffer = costexplorer.generateExcel(Deliver=False)
+        status['sheets'] = len(costexplorer.reports)
+        if buffer is not None:
+            filename, key = tenantPart(Account)
+            try:
+                #r+b, so a tenant finishing after TENANT_TIMEOUT does not recreate the file the parent removed
+                with open(Path, 'r+b') as f:
+                    f.write(buffer.getbuffer())
+            except FileNotFoundError:
+                pass
+            status['bytes'] = buffer.getbuffer().nbytes
+            buffer.seek(0)
+            uploadParts([(buffer, filename, key)])
+    except Exception as e:
+        logging.exception("Workbook for %s failed", Account)
+        status.update({'status': 'failed', 'error': '{}: {}'.format(e.__class__.__name__, e)})
+    status['seconds'] = round(time.time() - start, 3)
+    return status
+
+def tenantExecutor(Workers, Limits=(MAX_RPS, API_BUDGET)):
+    #Process pool for the CPU bound build and render, threads where processes are not available
+    #(AWS Lambda has no /dev/shm, daemonic pool workers can not have children)
+    #Limits are the (MaxRps, MaxRequests) of each process worker
+    import multiprocessing
+    if multiprocessing.current_process().daemon:
+        return ThreadPoolExecutor(max_workers=Workers)
+    try:
+        context = multiprocessing.get_context('fork')
+        return ProcessPoolExecutor(max_workers=Workers, mp_context=context, initializer=resetClients, initargs=Limits)
+    except (OSError, ValueError, ImportError) as e:
+        logging.warning("Process pool not available (%s), building tenant workbooks on threads", e)
+        return ThreadPoolExecutor(max_workers=Workers)
+
+def generateTenantWorkbooks(Accounts, CostTags, Workers=TENANT_WORKERS, Timeout=TENANT_TIMEOUT, Limiter=None, Budget=None):
+    """One workbook per GROUP_ACCOUNTS tenant, built and uploaded in parallel, returns the per tenant status rows
+
+    Tenants sharing a recipient list get one email, sent as soon as the last of them is done, so a slow
+    tenant only holds up its own batch. Tenants not done after Timeout seconds are reported as timeout.
+    All tenants stay within the run's Limiter rate and Budget, on threads by sharing them, on processes
+    by splitting them across the workers.
+    """
+    Limiter = Limiter or RateLimiter(MAX_RPS)
+    Budget = Budget or ApiBudget()
+    Workers = max(1, min(Workers, len(Accounts)))
+    share = 0
+    if Budget.max:
+        Budget.check(len(Accounts)) #At least one request per tenant
+        left = max(0, Budget.max - Budget.spent)
+        Workers = max(1, min(Workers, left))
+        #Never 0, which ApiBudget reads as unlimited
+        share = max(1, left // Workers)
+    batches = {}
+    for account in Accounts:
+        batches.setdefault(tenantRecipients(account), []).append(account)
+    results = {}
+    files = {account: tenantFile(account) for account in Accounts}
+
+    def sendReady():
+        for recipients, accounts in list(batches.items()):
+            if all(account in results for account in accounts):
+                del batches[recipients]
+                ready = [account for account in accounts if results[account]['status'] == 'ok' and results[account]['bytes']]
+                parts = [(open(files[account], 'rb'),) + tenantPart(account) for account in ready]
+                try:
+                    if parts:
+                        emailParts(parts, recipients)
+                except Exception:
+                    logging.exception("Email to %s failed", recipients)
+                finally:
+                    for buffer, filename, key in parts:
+                        buffer.close()
+                    for account in accounts:
+                        os.remove(files.pop(account))
+
+    executor = tenantExecutor(Workers, (Limiter.maxRps / Workers, share))
+    shared = (Limiter, Budget) if isinstance(executor, ThreadPoolExecutor) else (None, None)
+    futures = {}
+    try:
+        futures = {executor.submit(tenantWorkbook, account, CostTags, files[account], *shared): account for account in Accounts}
+        try:
+            for future in as_completed(futures, timeout=Timeout or None):
+                account = futures[future]
+                try:
+                    results[account] = future.result()
+                except Exception as e:
+                    #The worker itself died, e.g. killed for memory
+                    results[account] = {'tenant': account, 'status': 'failed', 'sheets': 0, 'bytes': 0, 'seconds': 0.0, 'error': e.__class__.__name__}
+                sendReady()
+        except FuturesTimeout:
+            for future, account in futures.items():
+                if account not in results:
+                    future.cancel()
+                    results[account] = {'tenant': account, 'status': 'timeout', 'sheets': 0, 'bytes': 0, 'seconds': Timeout, 'error': None}
+            sendReady()
+    finally:
+        #Queued tenants are dropped, shutdown(cancel_futures=True) needs Python 3.9 and the templates deploy 3.8
+        for future in futures:
+            future.cancel()
+        executor.shutdown(wait=False)
+        for path in files.values():
+            os.remove(path)
+    summary = [results[account] for account in Accounts]
+    for row in summary:
+        print("{tenant:<14} {status:<8} {sheets:>3} sheets {bytes:>10} bytes {seconds:>8}s {error}".format(**row))
+    print(json.dumps({'TenantSummary': summary}))
+    return summary
+
+def addDefaultReports(costexplorer, CostTags=None, Accounts=None, GroupAccounts=None, RiReports=RI_REPORTS):
+    """The main_handler report set, for the COST_TAGS / ACCOUNTS / GROUP_ACCOUNTS given"""
+    if Accounts: #Support for multiple/different Cost Allocation tags
+        costexplorer.addSummaryReport(Name="Summary", GroupBy=[],Style='Total',IncSupport=True, Accounts=Accounts)
+        #for account in Accounts.split(','):
             #Default addReport has filter to remove Support / Credits / Refunds / UpfrontRI / Tax
             
             #Overall Billing Reports
@@ -598,30 +2082,199 @@ def main_handler(event=None, context=None):
             
             #costexplorer.addReport(Name=account+"-Accounts", GroupBy=[{"Type": "DIMENSION","Key": "LINKED_ACCOUNT"}],Style='Total')
             #costexplorer.addReport(Name=account+"-Regions", GroupBy=[{"Type": "DIMENSION","Key": "REGION"}],Style='Total', AssumeAccount=account)
-        if os.environ.get('COST_TAGS'): #Support for multiple/different Cost Allocation tags
-            for group_account in os.environ.get('GROUP_ACCOUNTS').split(','):
-                for tagkey in os.environ.get('COST_TAGS').split(','):
+        if CostTags: #Support for multiple/different Cost Allocation tags
+            for group_account in GroupAccounts.split(','):
+                for tagkey in CostTags.split(','):
                     tabname = tagkey.replace(":",".") #Remove special chars from Excel tabname
                     costexplorer.addReport(Name=group_account+"-"+"{}".format(tabname)[:31], GroupBy=[{"Type": "TAG","Key": tagkey}],Style='Total', AssumeAccount=group_account)
     else:
-        costexplorer = CostExplorer(CurrentMonth=False)
-
         #Default addReport has filter to remove Support / Credits / Refunds / UpfrontRI / Tax
-        if os.environ.get('COST_TAGS'): #Support for multiple/different Cost Allocation tags
-            for tagkey in os.environ.get('COST_TAGS').split(','):
+        if CostTags: #Support for multiple/different Cost Allocation tags
+            for tagkey in CostTags.split(','):
                 tabname = tagkey.replace(":",".") #Remove special chars from Excel tabname
                 costexplorer.addReport(Name="{}".format(tabname)[:31], GroupBy=[{"Type": "TAG","Key": tagkey}],Style='Total')
                 costexplorer.addReport(Name="Change-{}".format(tabname)[:31], GroupBy=[{"Type": "TAG","Key": tagkey}],Style='Change')
-        #Overall Billing Reports
-        costexplorer.addReport(Name="Total", GroupBy=[],Style='Total',IncSupport=True)
-        costexplorer.addReport(Name="TotalChange", GroupBy=[],Style='Change')
-        #GroupBy Reports
-        costexplorer.addReport(Name="Services", GroupBy=[{"Type": "DIMENSION","Key": "SERVICE"}],Style='Total',IncSupport=True)
-        
-        #costexplorer.addReport(Name="Accounts", GroupBy=[{"Type": "DIMENSION","Key": "LINKED_ACCOUNT"}],Style='Total')
-        costexplorer.addReport(Name="Regions", GroupBy=[{"Type": "DIMENSION","Key": "REGION"}],Style='Total')
-    costexplorer.generateExcel()
+        if CUBE: #Same sheets rolled up from one SERVICE x REGION query per filter
+            costexplorer.addCubeReport(Name="Total", Style='Total', IncSupport=True)
+            costexplorer.addCubeReport(Name="TotalChange", Style='Change')
+            costexplorer.addCubeReport(Name="Services", Dimension='SERVICE', Style='Total', IncSupport=True)
+            costexplorer.addCubeReport(Name="Regions", Dimension='REGION', Style='Total')
+        else:
+            #Overall Billing Reports
+            costexplorer.addReport(Name="Total", GroupBy=[],Style='Total',IncSupport=True)
+            costexplorer.addReport(Name="TotalChange", GroupBy=[],Style='Change')
+            #GroupBy Reports
+            costexplorer.addReport(Name="Services", GroupBy=[{"Type": "DIMENSION","Key": "SERVICE"}],Style='Total',IncSupport=True)
+            
+            #costexplorer.addReport(Name="Accounts", GroupBy=[{"Type": "DIMENSION","Key": "LINKED_ACCOUNT"}],Style='Total')
+            costexplorer.addReport(Name="Regions", GroupBy=[{"Type": "DIMENSION","Key": "REGION"}],Style='Total')
+    if RiReports:
+        costexplorer.addRiReport(Name='RICoverage')
+        costexplorer.addRiReport(Name='RIUtilization')
+        costexplorer.addRiReport(Name='RIUtilizationSavings', Savings=True)
+        costexplorer.addRiRecommendations()
+
+def specAccounts(Accounts):
+    return {account.partition(':')[0] for account in (Accounts or '').split(',') if account}
+
+def validateSpec(spec, Trusted=SERVICE_TRUSTED):
+    """Raises ValueError for a spec runSpec cannot run, or that an untrusted caller may not run"""
+    if not isinstance(spec, dict):
+        raise ValueError("Report spec must be a JSON object")
+    if spec.get('Engine', ENGINE) not in ('pandas', 'lite'):
+        raise ValueError("Unknown engine {}".format(spec.get('Engine')))
+    entries = spec.get('reports', [])
+    if not isinstance(entries, list) or not all(isinstance(entry, dict) for entry in entries):
+        raise ValueError("reports must be a list of objects")
+    for entry in entries:
+        method = entry.get('report', 'addReport')
+        if method not in SPEC_REPORTS:
+            raise ValueError("Unknown report {}".format(method))
+        parameters = inspect.signature(getattr(CostExplorer, method)).parameters
+        unknown = [key for key in entry if key != 'report' and (key == 'self' or key not in parameters)]
+        if unknown:
+            raise ValueError("Unknown {} arguments {}".format(method, ', '.join(unknown)))
+    if Trusted:
+        return
+    if spec.get('deliver'):
+        raise ValueError("deliver needs SERVICE_TRUSTED")
+    if any(entry.get('AssumeAccount') for entry in entries):
+        raise ValueError("AssumeAccount needs SERVICE_TRUSTED")
+    #Summary and group account sheets assume roles too, only in the accounts the service is configured for
+    allowed = specAccounts(os.environ.get('ACCOUNTS')) | specAccounts(os.environ.get('GROUP_ACCOUNTS'))
+    for Accounts in [spec.get('ACCOUNTS'), spec.get('GROUP_ACCOUNTS')] + [entry.get('Accounts') for entry in entries]:
+        if not isinstance(Accounts, (str, type(None))):
+            raise ValueError("Accounts must be comma separated strings")
+        if specAccounts(Accounts) - allowed:
+            raise ValueError("Accounts {} are not configured on this service".format(', '.join(sorted(specAccounts(Accounts) - allowed))))
+
+def runSpec(spec, Limiter=None):
+    """Runs a JSON report spec, returns the workbook buffer
+
+    {"reports": [{"report": "addReport", "Name": "Services", "GroupBy": [...]}, ...]} calls the SPEC_REPORTS
+    methods in order, without "reports" the main_handler set is built from the spec's COST_TAGS, ACCOUNTS,
+    GROUP_ACCOUNTS and RI_REPORTS. "deliver": true also sends the workbook to S3 / SES.
+    Specs from outside are checked with validateSpec first.
+    """
+    costexplorer = CostExplorer(CurrentMonth=spec.get('CurrentMonth', False), Deferred=True, Engine=spec.get('Engine', ENGINE), Streaming=False, Limiter=Limiter)
+    if 'reports' in spec:
+        for entry in spec['reports']:
+            entry = dict(entry)
+            method = entry.pop('report', 'addReport')
+            if method not in SPEC_REPORTS:
+                raise ValueError("Unknown report {}".format(method))
+            getattr(costexplorer, method)(**entry)
+    else:
+        addDefaultReports(costexplorer, spec.get('COST_TAGS'), spec.get('ACCOUNTS'), spec.get('GROUP_ACCOUNTS'), spec.get('RI_REPORTS', RI_REPORTS))
+    return costexplorer.generateExcel(Deliver=spec.get('deliver', False))
+
+def serve(Port=SERVICE_PORT, Host=SERVICE_HOST):
+    """Service mode, a long running HTTP daemon that keeps clients, credentials, accounts and query results warm
+
+    POST / with a JSON report spec (see runSpec) replies with the workbook, GET /health with the query cache stats.
+    All requests share one query cache and one API rate limit. There is no authentication, so it listens
+    on SERVICE_HOST (local only by default) and untrusted specs are limited by validateSpec.
+    """
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+    cache = queryCache(QUERY_CACHE_TTL or 3600)
+    limiter = RateLimiter(MAX_RPS)
+
+    class ReportHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path != '/health':
+                return self.send_error(404)
+            self.reply(200, 'application/json', json.dumps(cache.stats()).encode('utf-8'))
+
+        def do_POST(self):
+            try:
+                spec = json.loads(self.rfile.read(int(self.headers.get('Content-Length') or 0)) or b'{}')
+                validateSpec(spec)
+            except ValueError as e:
+                return self.reply(400, 'application/json', json.dumps({'error': str(e)}).encode('utf-8'))
+            try:
+                buffer = runSpec(spec, limiter)
+            except Exception as e:
+                logging.exception("Report spec failed")
+                return self.reply(500, 'application/json', json.dumps({'error': e.__class__.__name__}).encode('utf-8'))
+            if buffer is None:
+                return self.reply(200, 'application/json', b'{"status": "Report Generated"}')
+            self.reply(200, 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet', buffer.getvalue())
+
+        def reply(self, status, contentType, body):
+            self.send_response(status)
+            self.send_header('Content-Type', contentType)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    server = ThreadingHTTPServer((Host, Port), ReportHandler)
+    print("Serving reports on {}:{}".format(Host, Port))
+    server.serve_forever()
+
+def reinvoke(event, context):
+    #Next step of a checkpointed run, started asynchronously on this same function
+    event = dict(event or {})
+    event['checkpointResumes'] = event.get('checkpointResumes', 0) + 1
+    if event['checkpointResumes'] > CHECKPOINT_MAX_RESUMES:
+        logging.warning("Checkpointed %d times, leaving the rest to the next trigger", CHECKPOINT_MAX_RESUMES)
+        return
+    getClient('lambda').invoke(FunctionName=context.invoked_function_arn, InvocationType='Event', Payload=json.dumps(event).encode('utf-8'))
+
+@profiled
+def main_handler(event=None, context=None): 
+    checkpoint = CheckpointStore() if CHECKPOINT else None
+    deadline = None
+    if checkpoint is not None and hasattr(context, 'get_remaining_time_in_millis'):
+        deadline = time.time() + context.get_remaining_time_in_millis() / 1000.0 - CHECKPOINT_MARGIN
+    costexplorer = CostExplorer(CurrentMonth=False, Deferred=DEFERRED, Checkpoint=checkpoint, Deadline=deadline)
+    #Tenant mode, the GROUP_ACCOUNTS x COST_TAGS sheets go to one workbook per group account instead
+    tenants = TENANT_WORKBOOKS and os.environ.get('ACCOUNTS') and os.environ.get('COST_TAGS')
+    #Delivered workbooks are checkpointed too, so a resumed run does not send them again
+    done = (lambda key: checkpoint.get(key)) if checkpoint is not None else (lambda key: None)
+    pending = []
+    try:
+        if not done('delivered:workbook'):
+            addDefaultReports(costexplorer, None if tenants else os.environ.get('COST_TAGS'), os.environ.get('ACCOUNTS'), os.environ.get('GROUP_ACCOUNTS'))
+            costexplorer.generateExcel()
+            if checkpoint is not None:
+                checkpoint.put('delivered:workbook', True)
+        pending = [account for account in os.environ.get('GROUP_ACCOUNTS').split(',') if not done('delivered:tenant:' + account)] if tenants else []
+        if pending:
+            timeout, bounded = TENANT_TIMEOUT, False
+            if deadline:
+                #Tenants not done by the deadline are left for the next run
+                if time.time() > deadline:
+                    raise CheckpointDeadline("Checkpoint deadline reached before the tenant workbooks")
+                bounded = not TENANT_TIMEOUT or deadline - time.time() < TENANT_TIMEOUT
+                timeout = deadline - time.time() if bounded else TENANT_TIMEOUT
+            summary = generateTenantWorkbooks(pending, os.environ.get('COST_TAGS'), Timeout=timeout, Limiter=costexplorer.limiter, Budget=costexplorer.budget)
+            #Only delivered tenants are checkpointed, failed ones (throttles, a crashed worker) are retried by a resumed run
+            for row in summary:
+                if row['status'] == 'ok' and checkpoint is not None:
+                    checkpoint.put('delivered:tenant:' + row['tenant'], True)
+            pending = [row['tenant'] for row in summary if row['status'] != 'ok']
+            if bounded and any(row['status'] == 'timeout' for row in summary):
+                raise CheckpointDeadline("Checkpoint deadline reached with tenant workbooks left")
+    except CheckpointDeadline:
+        if not checkpoint.added:
+            #Nothing completed in this step, running it again would not get further
+            logging.warning("Checkpoint deadline reached without completing a query, leaving the rest to the next trigger")
+            return "Report Checkpointed"
+        checkpoint.save(costexplorer.pendingReports() + pending)
+        if CHECKPOINT_REINVOKE and context is not None:
+            reinvoke(event, context)
+        return "Report Checkpointed"
+    except Exception:
+        #Whatever was fetched is kept for the next run
+        if checkpoint is not None and checkpoint.added:
+            checkpoint.save(costexplorer.pendingReports() + pending)
+        raise
+    if checkpoint is not None:
+        checkpoint.clear()
     return "Report Generated"
 
 if __name__ == '__main__':
-    main_handler()
+    if '--serve' in sys.argv:
+        serve()
+    else:
+        main_handler()